@@ -2,41 +2,59 @@
 # Main Flask application file for the Multi-School Academic System v8.0
 
 import os
-import pandas as pd
-from datetime import datetime, date
-from functools import wraps
+import hashlib
+import tempfile
+import orjson
+import xlsxwriter
+from datetime import date
+from functools import lru_cache, wraps
+from itertools import groupby
+from operator import attrgetter
+from types import MappingProxyType
 import io 
+try:
+    import fcntl
+except ImportError:  # Windows: no advisory locks, fall back to unguarded init
+    fcntl = None
 
 from flask import (
     Flask, render_template, redirect, url_for, flash, request,
-    session, abort, jsonify, Response, send_from_directory
+    session, abort, jsonify, Response, send_from_directory, send_file, make_response
 )
+from flask.json.provider import DefaultJSONProvider
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import (
     LoginManager, UserMixin, login_user, logout_user,
     current_user, login_required
 )
 from flask_wtf import FlaskForm
-from wtforms import StringField, PasswordField, SubmitField, SelectField, IntegerField
+from wtforms import StringField, PasswordField, SubmitField, SelectField, IntegerField, BooleanField
 from wtforms.fields import DateField, FileField
 from wtforms.validators import DataRequired, EqualTo, ValidationError, Length, NumberRange
 from flask_wtf.file import FileAllowed
 from flask_wtf.csrf import CSRFProtect
+from flask_caching import Cache
 from weasyprint import HTML
+from werkzeug.security import check_password_hash
+from sqlalchemy import event, exists, inspect, select, text, update
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.sql import func
+from sqlalchemy.orm import joinedload, selectinload
 
 # Import models and db instance
 from models import (
     db, School, User, Student, Teacher, Subject, Grade, UserRole, GradeLetter,
-    Parent, StudentLinkCode, Attendance, AttendanceStatus
+    Parent, StudentLinkCode, Attendance, AttendanceStatus, SchoolMetric, term_sort_key,
+    calculate_grade_letter, generate_admission_number, next_admission_sequence, upsert_insert
 )
 # Import utilities
 from utils.analytics import (
     get_student_grade_trend, get_class_grade_distribution, 
-    get_subject_averages, get_school_comparison
+    get_subject_averages, get_school_comparison, refresh_school_metrics
 )
-from utils.ai_predictor import generate_ai_remark, predict_next_term
-from utils.pdf_generator import generate_pdf_report
+from utils.ai_predictor import generate_term_remark, predict_next_term
+from utils.pdf_generator import cached_pdf_report, generate_bulk_pdf_report
+from utils.report_jobs import submit_report_job, get_report_job, discard_report_job
 from utils.csv_tools import load_data_from_csv
 # --- UPDATED IMPORT ---
 from utils.bulk_importer import (
@@ -47,51 +65,169 @@ from utils.bulk_importer import (
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 
+class OrjsonProvider(DefaultJSONProvider):
+    """Serializes jsonify() payloads with orjson; types it doesn't know fall back to Flask's encoder."""
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS).decode()
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 app.config['SECRET_KEY'] = 'a_very_secret_key_that_should_be_changed'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(basedir, 'data', 'ecosystem.db')
+# SQLite by default; point DATABASE_URL at PostgreSQL for production
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///' + os.path.join(basedir, 'data', 'ecosystem.db'))
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Enough pooled connections for concurrent chart/API requests per worker, recycled before servers drop idle ones
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'pool_pre_ping': True, 'pool_size': 20, 'max_overflow': 10, 'pool_recycle': 1800}
+if app.config['SQLALCHEMY_DATABASE_URI'].startswith(('postgresql://', 'postgresql+psycopg2://')):
+    # psycopg2: bulk INSERTs go out as multi-row VALUES pages, and executemany UPDATEs
+    # (e.g. the seed's next_student_seq bump) are batched with execute_batch
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'].update(
+        executemany_mode='values_plus_batch', insertmanyvalues_page_size=1000, executemany_batch_page_size=500
+    )
+app.config['REPORT_CACHE_DIR'] = os.path.join(basedir, 'cache', 'reports')
+# Worker processes per app process for class report PDFs, started on the first one; 1 renders in-process
+app.config['REPORT_RENDER_WORKERS'] = int(os.environ.get('REPORT_RENDER_WORKERS', os.cpu_count() or 1))
 
 # Initialize extensions
 db.init_app(app)
 csrf = CSRFProtect(app)
+# On disk so entries (and their invalidation) are shared by every worker process
+cache = Cache(app, config={'CACHE_TYPE': 'FileSystemCache', 'CACHE_DIR': os.path.join(basedir, 'cache', 'flask'), 'CACHE_DEFAULT_TIMEOUT': 300})
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'select_school'
 login_manager.login_message = "You must be logged in to access this page."
 login_manager.login_message_category = "danger"
 
+# In debug runs, log lazy loads that should have been eager-loaded (and eager loads that go unused).
+# nplusone is a dev-only tool: `pip install nplusone` to enable, and set NPLUSONE_RAISE to fail loudly.
+if app.debug:
+    try:
+        from nplusone.ext.flask_sqlalchemy import NPlusOne
+        app.config.setdefault('NPLUSONE_RAISE', os.environ.get('NPLUSONE_RAISE') == '1')
+        NPlusOne(app)
+    except ImportError:
+        pass
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    """WAL lets readers run alongside a writer; NORMAL sync fsyncs only at checkpoints; FKs are enforced."""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.execute("PRAGMA cache_size=-65536")  # 64 MB page cache
+    cursor.execute("PRAGMA mmap_size=268435456")  # 256 MB memory-mapped I/O
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+with app.app_context():
+    if db.engine.dialect.name == 'sqlite':
+        event.listen(db.engine, "connect", _set_sqlite_pragmas)
+
 # --- HELPER FUNCTIONS & DECORATORS ---
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    # Join the school and role profiles in so current_user.school, .teacher_profile etc. don't cost a SELECT each
+    return db.session.get(User, int(user_id), options=[
+        joinedload(User.school), joinedload(User.student_profile), joinedload(User.teacher_profile), joinedload(User.parent_profile)
+    ])
 
 def role_required(role):
+    """Requires a logged-in user with the given role; includes the @login_required check."""
     def decorator(f):
         @wraps(f)
         def decorated_function(*args, **kwargs):
-            if not current_user.is_authenticated or current_user.role != role:
+            # login_required has already rejected anonymous users; UserRole members are singletons
+            if current_user.role is not role:
                 abort(403)
             return f(*args, **kwargs)
-        return decorated_function
+        return login_required(decorated_function)
     return decorator
 
+require_super_admin = role_required(UserRole.SUPER_ADMIN)
+require_school_admin = role_required(UserRole.SCHOOL_ADMIN)
+require_teacher = role_required(UserRole.TEACHER)
+require_student = role_required(UserRole.STUDENT)
+require_parent = role_required(UserRole.PARENT)
+
 def get_current_school():
-    if current_user.is_authenticated and current_user.role != UserRole.SUPER_ADMIN:
-        return School.query.get(current_user.school_id)
+    """Returns the logged-in user's school; load_user joins it in, so this never queries."""
+    if current_user.is_authenticated and current_user.role is not UserRole.SUPER_ADMIN:
+        return current_user.school
     return None
 
-def calculate_grade_letter(marks):
-    if marks >= 90: return GradeLetter.AP
-    if marks >= 80: return GradeLetter.A
-    if marks >= 70: return GradeLetter.B
-    if marks >= 60: return GradeLetter.C
-    if marks >= 50: return GradeLetter.D
-    return GradeLetter.F
+@cache.memoize(timeout=600)
+def subject_choices(school_id):
+    """(id, name) pairs for a school's subject SelectField; cleared when subjects are added."""
+    return [tuple(row) for row in db.session.query(Subject.id, Subject.name).filter_by(school_id=school_id).order_by(Subject.name).all()]
+
+@cache.memoize(timeout=86400)
+def ai_insights(student_id, term, grades_fingerprint):
+    """
+    AI summary remark and next-term prediction for a student.
+
+    grades_fingerprint is only part of the cache key: it changes whenever any
+    of the student's grades do, so stale insights are never served.
+    """
+    return {"summary": generate_term_remark(student_id, term), "prediction": predict_next_term(student_id)}
+
+@cache.memoize(timeout=30)
+def school_stats(school_id):
+    """Headline counts for the admin dashboard, all four fetched in a single round-trip."""
+    counts = db.session.execute(select(*(
+        select(func.count()).select_from(model).where(model.school_id == school_id).scalar_subquery()
+        for model in (Student, Teacher, Subject, Parent)
+    ))).one()
+    return dict(zip(("student_count", "teacher_count", "subject_count", "parent_count"), counts))
+
+@cache.memoize(timeout=300)
+def cached_school_comparison():
+    return get_school_comparison()
+
+@cache.memoize(timeout=300)
+def cached_class_distribution(school_id, form_num):
+    return get_class_grade_distribution(school_id, form_num)
+
+def invalidate_grade_analytics(student=None):
+    """
+    Drops cached grade aggregates; call after any grade is written.
+
+    Given the student whose grade changed, only their class's distribution
+    is dropped and every other class keeps its cached chart.
+    """
+    cache.delete_memoized(cached_school_comparison)
+    if student is None: cache.delete_memoized(cached_class_distribution)
+    else: cache.delete_memoized(cached_class_distribution, student.school_id, student.form)
+
+def is_username_conflict(error):
+    """True if an IntegrityError came from the unique username constraint (SQLite or PostgreSQL wording)."""
+    return 'username' in str(error.orig)
+
+# Bulk upload templates: (sheet name, header columns) per template type
+EXCEL_TEMPLATES = {
+    'schools': ('Schools', ['SchoolName', 'SchoolCode', 'AdminUsername', 'AdminPassword']),
+    'subjects': ('Subjects', ['SubjectName']),
+    'students': ('Students', ['FullName', 'AdmissionYear', 'LoginUsername', 'InitialPassword']),
+}
+
+@lru_cache(maxsize=None)
+def excel_template_bytes(template_type):
+    """Builds a header-only .xlsx for a bulk upload template; the files never change, so each is built once."""
+    sheet_name, columns = EXCEL_TEMPLATES[template_type]
+    output = io.BytesIO()
+    workbook = xlsxwriter.Workbook(output, {'in_memory': True, 'constant_memory': True})
+    worksheet = workbook.add_worksheet(sheet_name)
+    worksheet.write_row(0, 0, columns, workbook.add_format({'bold': True}))
+    workbook.close()
+    return output.getvalue()
 
-def generate_admission_number(school_code_base, student_id, year_str):
-    return f"{school_code_base}/{student_id:05d}/{year_str}"
+def excel_template_response(template_type):
+    return Response(
+        excel_template_bytes(template_type),
+        mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        headers={"Content-Disposition": f"attachment;filename={template_type}_template.xlsx", "Cache-Control": "private, max-age=86400"}
+    )
 
 # --- DATABASE INITIALIZATION ---
 
@@ -104,18 +240,100 @@ def init_db_command():
     load_data_from_csv()
     print("Database initialized successfully!")
 
+def upgrade_schema():
+    """
+    Brings a database created by an older version up to the current models.
+
+    create_all() only creates missing tables, so columns and indexes added to
+    existing tables are applied here. Every step checks first, so running it
+    against an up-to-date database does nothing.
+    """
+    conn = db.session.connection()
+    inspector = inspect(conn)
+    school_columns = {col['name'] for col in inspector.get_columns('school')}
+    grade_columns = {col['name'] for col in inspector.get_columns('grade')}
+
+    if 'next_student_seq' not in school_columns:
+        conn.execute(text("ALTER TABLE school ADD COLUMN next_student_seq INTEGER NOT NULL DEFAULT 1"))
+        # Continue after the highest number already issued (older versions numbered by count + 1)
+        last_seq = {}
+        for school_id, adm_num in conn.execute(select(Student.school_id, Student.admission_number)):
+            parts = adm_num.split('/')
+            seq = int(parts[1]) if len(parts) == 3 and parts[1].isdigit() else 0
+            last_seq[school_id] = max(last_seq.get(school_id, 0), seq)
+        counts = dict(conn.execute(select(Student.school_id, func.count()).group_by(Student.school_id)).all())
+        for school_id in set(last_seq) | set(counts):
+            conn.execute(update(School).where(School.id == school_id).values(
+                next_student_seq=max(last_seq.get(school_id, 0), counts.get(school_id, 0)) + 1
+            ))
+
+    if 'term_order' not in grade_columns:
+        conn.execute(text("ALTER TABLE grade ADD COLUMN term_order INTEGER NOT NULL DEFAULT 0"))
+        for (term,) in conn.execute(select(Grade.term).distinct()).all():
+            conn.execute(update(Grade).where(Grade.term == term).values(term_order=term_sort_key(term)))
+
+    existing_indexes = {
+        table: {index['name'] for index in inspector.get_indexes(table)} for table in ('grade', 'attendance')
+    }
+    # The upserts' conflict targets are unique: keep only the newest row of any duplicate before indexing
+    if 'ix_grade_lookup' not in existing_indexes['grade']:
+        conn.execute(text(
+            "DELETE FROM grade WHERE id NOT IN (SELECT MAX(id) FROM grade GROUP BY student_id, subject_id, term)"
+        ))
+    if 'ix_attendance_date_student' not in existing_indexes['attendance']:
+        conn.execute(text(
+            "DELETE FROM attendance WHERE id NOT IN (SELECT MAX(id) FROM attendance GROUP BY date, student_id)"
+        ))
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+    db.session.commit()
+
+def ensure_db():
+    """
+    Creates any missing tables, upgrades older schemas and seeds the mock data if the database is empty.
+
+    Safe to call from several worker processes at once: an exclusive lock on
+    data/.init.lock serializes them, so only the first one seeds.
+    """
+    with open(os.path.join(basedir, 'data', '.init.lock'), 'w') as lock_file:
+        if fcntl: fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            db.create_all()
+            upgrade_schema()
+            seeded = db.session.execute(select(School.id).limit(1)).first() is None
+            if seeded:
+                print("Database is empty. Loading data from CSV files...")
+                load_data_from_csv()
+                print("Database created and initialized.")
+            # Grades written before the metrics table existed (or by the seed) have no SchoolMetric row yet
+            unmeasured = select(Student.school_id).join(Grade, Grade.student_id == Student.id).where(
+                ~Student.school_id.in_(select(SchoolMetric.school_id))
+            ).limit(1)
+            if db.session.execute(unmeasured).first() is not None:
+                refresh_school_metrics()
+                db.session.commit()
+            if db.engine.dialect.name == 'sqlite':
+                # Keep planner statistics current so the composite indexes get picked
+                db.session.execute(text("ANALYZE" if seeded else "PRAGMA optimize"))
+        finally:
+            if fcntl: fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+@app.cli.command("ensure-db")
+def ensure_db_command():
+    ensure_db()
+
 with app.app_context():
-    if not os.path.exists(os.path.join(basedir, 'data', 'ecosystem.db')):
-        print("Database not found. Creating and initializing...")
-        db.create_all()
-        load_data_from_csv()
-        print("Database created and initialized.")
+    ensure_db()
 
 # --- FORMS (WTForms) ---
 
+TERMS = ('Term 1 2025', 'Term 2 2025', 'Term 3 2025')
+
 class LoginForm(FlaskForm):
     username = StringField('Username', validators=[DataRequired()])
     password = PasswordField('Password', validators=[DataRequired()])
+    remember = BooleanField('Remember me')
     submit = SubmitField('Login')
 
 class SchoolRegistrationForm(FlaskForm):
@@ -124,15 +342,21 @@ class SchoolRegistrationForm(FlaskForm):
     admin_username = StringField('Admin Username', validators=[DataRequired(), Length(min=4, max=100)])
     admin_password = PasswordField('Admin Password', validators=[DataRequired(), Length(min=6)])
     submit = SubmitField('Register School')
-    def validate_school_code(self, field):
-        if School.query.filter_by(school_code=field.data).first(): raise ValidationError('This School Code is already taken.')
-    def validate_admin_username(self, field):
-        if User.query.filter_by(username=field.data).first(): raise ValidationError('This Admin Username is already taken.')
+    def validate(self, extra_validators=None):
+        if not super().validate(extra_validators): return False
+        # Check both uniqueness rules in a single round-trip
+        taken = db.session.execute(select(
+            exists().where(School.school_code == self.school_code.data).label('school_code'),
+            exists().where(User.username == self.admin_username.data).label('admin_username'),
+        )).one()
+        if taken.school_code: self.school_code.errors.append('This School Code is already taken.')
+        if taken.admin_username: self.admin_username.errors.append('This Admin Username is already taken.')
+        return not (taken.school_code or taken.admin_username)
 
 class GradeEntryForm(FlaskForm):
     student_admission = StringField('Student Admission Number', validators=[DataRequired()])
     subject_id = SelectField('Subject', coerce=int, validators=[DataRequired()])
-    term = SelectField('Term', choices=[('Term 1 2025', 'Term 1 2025'), ('Term 2 2025', 'Term 2 2025'), ('Term 3 2025', 'Term 3 2025')], validators=[DataRequired()])
+    term = SelectField('Term', choices=[(t, t) for t in TERMS], validators=[DataRequired()])
     marks = IntegerField('Marks (0-100)', validators=[DataRequired()])
     submit = SubmitField('Submit Grade')
 
@@ -193,11 +417,25 @@ def internal_server(error):
     return render_template('errors/500.html'), 500
 
 # --- AUTHENTICATION & PUBLIC ROUTES ---
+
+# Login URL role -> (template, UserRole, whether the URL's school code applies); parents share the admin page
+LOGIN_ROLES = MappingProxyType({
+    "admin": ("admin_login.html", UserRole.SCHOOL_ADMIN, True),
+    "teacher": ("teacher_login.html", UserRole.TEACHER, True),
+    "student": ("student_login.html", UserRole.STUDENT, True),
+    "super_admin": ("admin_login.html", UserRole.SUPER_ADMIN, False),
+    "parent": ("admin_login.html", UserRole.PARENT, True),
+})
+
 @app.route('/')
+@cache.cached(timeout=300, key_prefix='select_school', unless=lambda: current_user.is_authenticated or '_flashes' in session)
 def select_school():
     if current_user.is_authenticated: return redirect(url_for('dashboard'))
-    schools = School.query.order_by(School.name).all()
-    return render_template('school_select.html', schools=schools)
+    schools = db.session.query(School.school_code, School.name).order_by(School.name).all()
+    response = make_response(render_template('school_select.html', schools=schools))
+    # Anonymous landing page: browsers may reuse it briefly, but never across a login/flash cookie change
+    response.cache_control.public = True; response.cache_control.max_age = 60; response.vary.add('Cookie')
+    return response
 
 @app.route('/register/parent/<school_code>', methods=['GET', 'POST'])
 def parent_register(school_code):
@@ -216,34 +454,32 @@ def parent_register(school_code):
             login_user(new_user)
             flash('Account created successfully! Now, please link your first student.', 'success')
             return redirect(url_for('parent_link_student'))
-        except Exception as e:
+        except IntegrityError as e:
             db.session.rollback()
-            if 'UNIQUE constraint failed: user.username' in str(e): flash('This username is already taken.', 'danger')
-            else: flash(f'Error creating account: {e}', 'danger')
+            if is_username_conflict(e): flash('This username is already taken.', 'danger')
+            else: flash('Could not create the account: it conflicts with an existing record.', 'danger')
+        except Exception as e:
+            db.session.rollback(); flash(f'Error creating account: {e}', 'danger')
     return render_template('parent_register.html', form=form, school=school)
 
 @app.route('/login/<role>/<school_code>', methods=['GET', 'POST'])
 def login(role, school_code):
     if current_user.is_authenticated: return redirect(url_for('dashboard'))
+    if role not in LOGIN_ROLES: abort(404)
+    template, role_enum, needs_school = LOGIN_ROLES[role]
+    school = School.query.filter_by(school_code=school_code).first_or_404() if needs_school else None
     form = LoginForm()
-    if role == "super_admin": school = None
-    else: school = School.query.filter_by(school_code=school_code).first_or_404()
-    template_map = {
-        "admin": ("admin_login.html", UserRole.SCHOOL_ADMIN), "teacher": ("teacher_login.html", UserRole.TEACHER),
-        "student": ("student_login.html", UserRole.STUDENT), "super_admin": ("admin_login.html", UserRole.SUPER_ADMIN),
-        "parent": ("parent_login.html", UserRole.PARENT)
-    }
-    if role not in template_map: abort(404)
-    template, role_enum = template_map[role]
     if form.validate_on_submit():
-        if school: user = User.query.filter_by(username=form.username.data, school_id=school.id, role=role_enum).first()
-        else: user = User.query.filter_by(username=form.username.data, role=UserRole.SUPER_ADMIN).first()
-        if user and user.check_password(form.password.data):
-            login_user(user, remember=True)
+        # Only the id and hash are needed to check the password; the full user is loaded on success
+        query = db.session.query(User.id, User.password_hash).filter_by(username=form.username.data, role=role_enum)
+        if school: query = query.filter_by(school_id=school.id)
+        credentials = query.first()
+        if credentials and credentials.password_hash and check_password_hash(credentials.password_hash, form.password.data):
+            user = load_user(credentials.id)
+            login_user(user, remember=form.remember.data)
             flash(f'Welcome back, {user.username}!', 'success')
             return redirect(url_for('dashboard'))
         else: flash('Invalid username or password.', 'danger')
-    if template == "parent_login.html": template = "admin_login.html"
     return render_template(template, form=form, school=school, role=role)
 
 @app.route('/logout')
@@ -266,8 +502,7 @@ def dashboard():
 
 # --- 1. SUPER ADMIN DASHBOARD ---
 @app.route('/dashboard/super_admin', methods=['GET', 'POST'])
-@login_required
-@role_required(UserRole.SUPER_ADMIN)
+@require_super_admin
 def super_admin_dashboard():
     form = SchoolRegistrationForm()
     bulk_form = SchoolUploadForm() # <-- NEW
@@ -283,6 +518,7 @@ def super_admin_dashboard():
             admin_user.set_password(form.admin_password.data)
             db.session.add(admin_user)
             db.session.commit()
+            cache.delete('select_school')
             flash(f"School '{new_school.name}' and admin '{admin_user.username}' created!", 'success')
             return redirect(url_for('super_admin_dashboard'))
         except Exception as e:
@@ -294,6 +530,7 @@ def super_admin_dashboard():
         try:
             file = bulk_form.school_file.data
             report = process_school_upload(file)
+            if report['added']: cache.delete('select_school')
             flash(f"School import complete! Added: {report['added']}, Skipped: {report['skipped']}.", "success")
             if report['errors']:
                 flash("Some rows were skipped (see details below).", "warning")
@@ -301,70 +538,52 @@ def super_admin_dashboard():
             flash(f"An error occurred during school import: {e}", "danger")
         # Need to reload schools list after import
         schools = School.query.all()
-        return render_template('dashboards/super_admin_dashboard.html', form=form, bulk_form=bulk_form, schools=schools, comparison_data=get_school_comparison(), report=report)
+        return render_template('dashboards/super_admin_dashboard.html', form=form, bulk_form=bulk_form, schools=schools, comparison_data=cached_school_comparison(), report=report)
 
     schools = School.query.all()
-    comparison_data = get_school_comparison()
+    comparison_data = cached_school_comparison()
     return render_template('dashboards/super_admin_dashboard.html', form=form, bulk_form=bulk_form, schools=schools, comparison_data=comparison_data, report=report)
 
 # --- NEW: SUPER ADMIN TEMPLATE DOWNLOAD ---
 @app.route('/super_admin/bulk/download/schools_template')
-@login_required
-@role_required(UserRole.SUPER_ADMIN)
+@require_super_admin
 def super_admin_download_template():
-    output = io.BytesIO()
-    writer = pd.ExcelWriter(output, engine='xlsxwriter')
-    df = pd.DataFrame(columns=['SchoolName', 'SchoolCode', 'AdminUsername', 'AdminPassword'])
-    df.to_excel(writer, index=False, sheet_name='Schools')
-    writer.close()
-    output.seek(0)
-    
-    return Response(
-        output,
-        mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        headers={"Content-Disposition": "attachment;filename=schools_template.xlsx"}
-    )
+    return excel_template_response('schools')
 
 # --- 2. SCHOOL ADMIN DASHBOARD ---
 @app.route('/dashboard/admin')
-@login_required
-@role_required(UserRole.SCHOOL_ADMIN)
+@require_school_admin
 def admin_dashboard():
     school = get_current_school()
-    student_count = Student.query.filter_by(school_id=school.id).count()
-    teacher_count = Teacher.query.filter_by(school_id=school.id).count()
-    subject_count = Subject.query.filter_by(school_id=school.id).count()
-    parent_count = Parent.query.filter_by(school_id=school.id).count()
-    stats = {"student_count": student_count, "teacher_count": teacher_count, "subject_count": subject_count, "parent_count": parent_count}
-    return render_template('dashboards/admin_dashboard.html', school=school, stats=stats)
+    stats = school_stats(school.id)
+    return render_template('dashboards/admin_dashboard.html', school=school, stats=stats, terms=TERMS)
 
 @app.route('/admin/students', methods=['GET', 'POST'])
-@login_required
-@role_required(UserRole.SCHOOL_ADMIN)
+@require_school_admin
 def admin_manage_students():
     school = get_current_school(); form = StudentRegistrationForm()
     if form.validate_on_submit():
         try:
             new_user = User(username=form.username.data, role=UserRole.STUDENT, school_id=school.id)
             new_user.set_password(form.password.data); db.session.add(new_user); db.session.flush()
-            student_count = Student.query.filter_by(school_id=school.id).count() + 1
-            school_code_base = school.school_code.split('@')[0]; adm_year = form.admission_year.data
-            year_str = str(adm_year)[-2:]
-            adm_num = generate_admission_number(school_code_base, student_count, year_str)
+            student_seq = next_admission_sequence(school.id)
+            adm_year = form.admission_year.data
+            adm_num = generate_admission_number(school.school_code_base, student_seq, adm_year)
             new_student = Student(full_name=form.full_name.data, admission_number=adm_num, admission_year=adm_year, user_id=new_user.id, school_id=school.id)
             db.session.add(new_student); db.session.commit()
             flash(f'Student {new_student.full_name} ({adm_num}) created successfully!', 'success')
             return redirect(url_for('admin_manage_students'))
-        except Exception as e:
+        except IntegrityError as e:
             db.session.rollback()
-            if 'UNIQUE constraint failed: user.username' in str(e): flash('This username is already taken.', 'danger')
-            else: flash(f'Error creating student: {e}', 'danger')
+            if is_username_conflict(e): flash('This username is already taken.', 'danger')
+            else: flash('Could not create the student: it conflicts with an existing record.', 'danger')
+        except Exception as e:
+            db.session.rollback(); flash(f'Error creating student: {e}', 'danger')
     students = Student.query.filter_by(school_id=school.id).order_by(Student.admission_year.desc(), Student.full_name).all()
     return render_template('admin/manage_students.html', form=form, students=students, school=school)
 
 @app.route('/admin/students/generate_code/<int:student_id>', methods=['POST'])
-@login_required
-@role_required(UserRole.SCHOOL_ADMIN)
+@require_school_admin
 def admin_generate_link_code(student_id):
     student = Student.query.get_or_404(student_id)
     if student.school_id != current_user.school_id: abort(403)
@@ -375,14 +594,14 @@ def admin_generate_link_code(student_id):
     return redirect(url_for('admin_manage_students'))
 
 @app.route('/admin/subjects', methods=['GET', 'POST'])
-@login_required
-@role_required(UserRole.SCHOOL_ADMIN)
+@require_school_admin
 def admin_manage_subjects():
     school = get_current_school(); form = SubjectForm()
     if form.validate_on_submit():
         try:
             new_subject = Subject(name=form.name.data, school_id=school.id)
             db.session.add(new_subject); db.session.commit()
+            cache.delete_memoized(subject_choices, school.id)
             flash(f'Subject "{new_subject.name}" added successfully!', 'success')
             return redirect(url_for('admin_manage_subjects'))
         except Exception as e:
@@ -392,8 +611,7 @@ def admin_manage_subjects():
 
 # --- UPDATED BULK DATA ROUTES ---
 @app.route('/admin/bulk_manage', methods=['GET', 'POST'])
-@login_required
-@role_required(UserRole.SCHOOL_ADMIN)
+@require_school_admin
 def admin_bulk_manage():
     subject_form = SubjectUploadForm()
     student_form = StudentUploadForm() 
@@ -402,6 +620,7 @@ def admin_bulk_manage():
         try:
             file = subject_form.subject_file.data
             report = process_subject_upload(file, current_user.school_id)
+            if report['added']: cache.delete_memoized(subject_choices, current_user.school_id)
             flash(f"Subject import complete! Added: {report['added']}, Skipped: {report['skipped']}.", "success")
             if report['errors']: flash("Some rows were skipped (see details below).", "warning")
         except Exception as e:
@@ -418,74 +637,62 @@ def admin_bulk_manage():
     return render_template('admin/bulk_manage.html', subject_form=subject_form, student_form=student_form, report=report)
 
 @app.route('/admin/bulk/download/<template_type>')
-@login_required
-@role_required(UserRole.SCHOOL_ADMIN)
+@require_school_admin
 def download_template(template_type):
-    output = io.BytesIO(); writer = pd.ExcelWriter(output, engine='xlsxwriter')
-    if template_type == 'subjects':
-        df = pd.DataFrame(columns=['SubjectName'])
-        df.to_excel(writer, index=False, sheet_name='Subjects')
-        filename = "subjects_template.xlsx"
-    elif template_type == 'students':
-        df = pd.DataFrame(columns=['FullName', 'AdmissionYear', 'LoginUsername', 'InitialPassword'])
-        df.to_excel(writer, index=False, sheet_name='Students')
-        filename = "students_template.xlsx"
-    else: abort(404)
-    writer.close(); output.seek(0)
-    return Response(output, mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", headers={"Content-Disposition": f"attachment;filename={filename}"})
+    if template_type not in ('subjects', 'students'): abort(404)
+    return excel_template_response(template_type)
 
 # --- 3. TEACHER DASHBOARD ---
 @app.route('/dashboard/teacher', methods=['GET', 'POST'])
-@login_required
-@role_required(UserRole.TEACHER)
+@require_teacher
 def teacher_dashboard():
     school = get_current_school(); teacher = current_user.teacher_profile; form = GradeEntryForm()
-    form.subject_id.choices = [(s.id, s.name) for s in Subject.query.filter_by(school_id=school.id).order_by(Subject.name).all()]
+    form.subject_id.choices = subject_choices(school.id)
     if form.validate_on_submit():
         student = Student.query.filter_by(admission_number=form.student_admission.data, school_id=school.id).first()
         if not student: flash('Error: Student admission number not found for this school.', 'danger')
         else:
             try:
-                existing_grade = Grade.query.filter_by(student_id=student.id, subject_id=form.subject_id.data, term=form.term.data).first()
-                if existing_grade:
-                    existing_grade.marks = form.marks.data; existing_grade.grade_letter = calculate_grade_letter(form.marks.data); existing_grade.teacher_id = teacher.id
-                    flash('Grade updated successfully!', 'success')
-                else:
-                    new_grade = Grade(marks=form.marks.data, grade_letter=calculate_grade_letter(form.marks.data), term=form.term.data, student_id=student.id, subject_id=form.subject_id.data, teacher_id=teacher.id)
-                    db.session.add(new_grade)
+                stmt = upsert_insert(Grade).values(student_id=student.id, subject_id=form.subject_id.data, term=form.term.data, marks=form.marks.data, grade_letter=calculate_grade_letter(form.marks.data), teacher_id=teacher.id)
+                db.session.execute(stmt.on_conflict_do_update(index_elements=['student_id', 'subject_id', 'term'], set_={
+                    "marks": stmt.excluded.marks, "grade_letter": stmt.excluded.grade_letter, "teacher_id": stmt.excluded.teacher_id
+                }))
+                refresh_school_metrics(student.school_id)
                 db.session.commit()
+                invalidate_grade_analytics(student)
                 flash('Grade submitted successfully!', 'success')
                 return redirect(url_for('teacher_dashboard'))
             except Exception as e:
                 db.session.rollback(); flash(f"Error submitting grade: {e}", 'danger')
-    recent_grades = Grade.query.filter_by(teacher_id=teacher.id).order_by(Grade.id.desc()).limit(10).all()
+    recent_grades = Grade.query.options(selectinload(Grade.student), selectinload(Grade.subject)).filter_by(teacher_id=teacher.id).order_by(Grade.id.desc()).limit(10).all()
     return render_template('dashboards/teacher_dashboard.html', school=school, teacher=teacher, form=form, recent_grades=recent_grades)
 
 # --- ATTENDANCE ROUTES ---
 @app.route('/teacher/attendance', methods=['GET'])
-@login_required
-@role_required(UserRole.TEACHER)
+@require_teacher
 def teacher_attendance():
     form = AttendanceSelectionForm()
-    form.date.data = datetime.strptime(request.args.get('date'), '%Y-%m-%d').date() if request.args.get('date') else date.today()
+    try: form.date.data = date.fromisoformat(request.args.get('date')) if request.args.get('date') else date.today()
+    except ValueError: abort(400)
     form.form_num.data = int(request.args.get('form_num')) if request.args.get('form_num') else 1
     return render_template('teacher/take_attendance.html', form=form)
 
 @app.route('/teacher/attendance/roster', methods=['GET', 'POST'])
-@login_required
-@role_required(UserRole.TEACHER)
+@require_teacher
 def teacher_attendance_roster():
     teacher = current_user.teacher_profile; school_id = current_user.school_id
     if request.method == 'POST':
         try:
-            date_str = request.form.get('date'); date_obj = datetime.strptime(date_str, '%Y-%m-%d').date()
+            date_str = request.form.get('date'); date_obj = date.fromisoformat(date_str)
             teacher_id = teacher.id; form_num = request.form.get('form_num')
-            for key, status in request.form.items():
-                if key.startswith('student_'):
-                    student_id = key.split('_')[1]
-                    att = Attendance.query.filter_by(date=date_obj, student_id=student_id).first()
-                    if att: att.status = AttendanceStatus(status); att.teacher_id = teacher_id
-                    else: att = Attendance(date=date_obj, status=AttendanceStatus(status), student_id=student_id, teacher_id=teacher_id); db.session.add(att)
+            records = [
+                {"date": date_obj, "student_id": int(key.split('_')[1]), "status": AttendanceStatus(status), "teacher_id": teacher_id}
+                for key, status in request.form.items() if key.startswith('student_')
+            ]
+            if records:
+                # Whole roster in one statement: insert new marks, overwrite existing ones for the day
+                stmt = upsert_insert(Attendance).values(records)
+                db.session.execute(stmt.on_conflict_do_update(index_elements=['date', 'student_id'], set_={"status": stmt.excluded.status, "teacher_id": stmt.excluded.teacher_id}))
             db.session.commit()
             flash(f"Attendance for Form {form_num} on {date_str} saved successfully!", "success")
             return redirect(url_for('teacher_attendance'))
@@ -494,54 +701,54 @@ def teacher_attendance_roster():
             return redirect(url_for('teacher_attendance'))
     form_num = request.args.get('form_num', 1, type=int); date_str = request.args.get('date')
     if not date_str: date_obj = date.today(); date_str = date_obj.isoformat()
-    else: date_obj = datetime.strptime(date_str, '%Y-%m-%d').date()
-    current_year = date.today().year; required_admission_year = (current_year - form_num) + 1
-    students = Student.query.filter_by(school_id=school_id, admission_year=required_admission_year).order_by(Student.full_name).all()
-    existing_records_raw = Attendance.query.filter_by(date=date_obj).all()
-    existing_records = {rec.student_id: rec.status for rec in existing_records_raw}
+    else:
+        try: date_obj = date.fromisoformat(date_str)
+        except ValueError: abort(400)
+    students = Student.query.filter(Student.school_id == school_id, Student.in_form(form_num)).order_by(Student.full_name).all()
+    # Only the two columns the roster needs, not full Attendance objects
+    existing_records = dict(db.session.query(Attendance.student_id, Attendance.status).filter_by(date=date_obj).all())
     return render_template('teacher/attendance_roster.html', students=students, date=date_obj, date_str=date_str, form_num=form_num, existing_records=existing_records, AttendanceStatus=AttendanceStatus)
 
 # --- 4. STUDENT DASHBOARD ---
 @app.route('/dashboard/student')
-@login_required
-@role_required(UserRole.STUDENT)
+@require_student
 def student_dashboard():
     school = get_current_school(); student = current_user.student_profile
-    grades_by_term = {}; all_grades = Grade.query.filter_by(student_id=student.id).order_by(Grade.term).all()
-    for grade in all_grades:
-        if grade.term not in grades_by_term: grades_by_term[grade.term] = []
-        grades_by_term[grade.term].append(grade)
+    grade_rows = Grade.query.options(selectinload(Grade.subject), selectinload(Grade.teacher)).filter_by(student_id=student.id).order_by(Grade.term_order, Grade.term).yield_per(500)
+    # Rows stream in batches sorted by term, so each term is one contiguous run
+    grades_by_term = {term: list(grades) for term, grades in groupby(grade_rows, key=attrgetter('term'))}
     latest_term = "Term 1 2025"; ai_remarks = {}
     if latest_term in grades_by_term:
-        latest_grades = grades_by_term[latest_term]
-        ai_remarks = {"summary": generate_ai_remark(latest_grades), "prediction": predict_next_term(student.id)}
+        grades_fingerprint = hashlib.sha1(repr([(grade.id, grade.subject_id, grade.marks) for grades in grades_by_term.values() for grade in grades]).encode()).hexdigest()
+        ai_remarks = ai_insights(student.id, latest_term, grades_fingerprint)
     attendance_summary = db.session.query(Attendance.status, func.count(Attendance.status)).filter(Attendance.student_id == student.id).group_by(Attendance.status).all()
     att_summary_dict = {status.name: count for status, count in attendance_summary}
     return render_template('dashboards/student_dashboard.html', school=school, student=student, grades_by_term=grades_by_term, ai_remarks=ai_remarks, attendance_summary=att_summary_dict)
 
 # --- 5. PARENT DASHBOARD & LINKING ---
 @app.route('/dashboard/parent')
-@login_required
-@role_required(UserRole.PARENT)
+@require_parent
 def parent_dashboard():
     parent = current_user.parent_profile; students = parent.children
     if not students:
         flash("Please link a student to view your dashboard.", "info")
         return redirect(url_for('parent_link_student'))
-    student_data = []
-    for student in students:
-        grades_by_term = {}; all_grades = Grade.query.filter_by(student_id=student.id).order_by(Grade.term.desc()).all()
-        for grade in all_grades:
-            if grade.term not in grades_by_term: grades_by_term[grade.term] = []
-            grades_by_term[grade.term].append(grade)
-        attendance_summary = db.session.query(Attendance.status, func.count(Attendance.status)).filter(Attendance.student_id == student.id).group_by(Attendance.status).all()
-        att_summary_dict = {status.name: count for status, count in attendance_summary}
-        student_data.append({"student": student, "grades_by_term": grades_by_term, "attendance_summary": att_summary_dict})
+    # One grade query and one attendance aggregate cover every linked child
+    student_ids = [student.id for student in students]
+    grades_map = {student_id: {} for student_id in student_ids}
+    grade_rows = Grade.query.options(selectinload(Grade.subject).load_only(Subject.name)).filter(Grade.student_id.in_(student_ids)).order_by(Grade.student_id, Grade.term_order.desc(), Grade.term).yield_per(500)
+    # Streamed in batches sorted by student then term, so both levels group as contiguous runs
+    for student_id, student_grades in groupby(grade_rows, key=attrgetter('student_id')):
+        grades_map[student_id] = {term: list(grades) for term, grades in groupby(student_grades, key=attrgetter('term'))}
+    att_map = {student_id: {} for student_id in student_ids}
+    attendance_summary = db.session.query(Attendance.student_id, Attendance.status, func.count(Attendance.status)).filter(Attendance.student_id.in_(student_ids)).group_by(Attendance.student_id, Attendance.status).all()
+    for student_id, status, count in attendance_summary:
+        att_map[student_id][status.name] = count
+    student_data = [{"student": student, "grades_by_term": grades_map[student.id], "attendance_summary": att_map[student.id]} for student in students]
     return render_template('dashboards/parent_dashboard.html', parent=parent, student_data=student_data)
 
 @app.route('/parent/link_student', methods=['GET', 'POST'])
-@login_required
-@role_required(UserRole.PARENT)
+@require_parent
 def parent_link_student():
     form = LinkStudentForm(); parent = current_user.parent_profile
     if form.validate_on_submit():
@@ -567,30 +774,74 @@ def download_report_card(student_id, term):
     if current_user.role == UserRole.STUDENT and current_user.student_profile.id != student_id: abort(403)
     if (current_user.role == UserRole.TEACHER or current_user.role == UserRole.SCHOOL_ADMIN) and current_user.school_id != student.school_id: abort(403)
     if current_user.role == UserRole.PARENT:
-        if student not in current_user.parent_profile.children: abort(403)
-    grades = Grade.query.filter_by(student_id=student.id, term=term).all()
+        if not current_user.parent_profile.has_child(student_id): abort(403)
+    wants_json = request.accept_mimetypes.best == 'application/json'
+    filename = f"{student.admission_number.replace('/', '-')}_{term.replace(' ', '_')}_Report.pdf"
+    if wants_json:
+        # Queue the render and let the client poll report_status for the file
+        if not db.session.query(Grade.query.filter_by(student_id=student.id, term=term).exists()).scalar():
+            return jsonify({"error": f"No grades found for {student.full_name} in {term}."}), 404
+        job_id = submit_report_job(app, cache, current_user.id, student.id, term, filename)
+        return jsonify({"job_id": job_id, "status_url": url_for('report_status', job_id=job_id)}), 202
+    grades = Grade.query.options(joinedload(Grade.subject), joinedload(Grade.teacher)).filter_by(student_id=student.id, term=term).all()
     if not grades:
         flash(f"No grades found for {student.full_name} in {term}.", 'warning')
         return redirect(request.referrer or url_for('dashboard'))
-    pdf_bytes = generate_pdf_report(student, grades, term)
-    filename = f"{student.admission_number.replace('/', '-')}_{term.replace(' ', '_')}_Report.pdf"
-    return Response(pdf_bytes, mimetype="application/pdf", headers={"Content-disposition": f"attachment; filename={filename}"})
+    return send_file(cached_pdf_report(student, grades, term), mimetype="application/pdf", as_attachment=True, download_name=filename)
+
+@app.route('/report/pdf/bulk/<int:form_num>/<term>')
+@require_school_admin
+def download_class_report_cards(form_num, term):
+    # Students in name order, each with only this term's grades attached by one IN-clause selectin query
+    term_grades = Student.grades.and_(Grade.term == term)
+    students = Student.query.options(
+        selectinload(term_grades).options(joinedload(Grade.subject), joinedload(Grade.teacher))
+    ).filter(
+        Student.school_id == current_user.school_id, Student.in_form(form_num), Student.grades.any(Grade.term == term)
+    ).order_by(Student.full_name, Student.id).all()
+    if not students:
+        flash(f"No grades found for Form {form_num} in {term}.", 'warning')
+        return redirect(request.referrer or url_for('dashboard'))
+    # Class PDFs can be large: spool to disk past 8 MB and stream it back, rather than holding it all in memory
+    pdf_file = tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024)
+    generate_bulk_pdf_report([(student, student.grades) for student in students], term, target=pdf_file)
+    pdf_size = pdf_file.tell(); pdf_file.seek(0)
+    filename = f"Form_{form_num}_{term.replace(' ', '_')}_Reports.pdf"
+    response = send_file(pdf_file, mimetype="application/pdf", as_attachment=True, download_name=filename)
+    response.content_length = pdf_size
+    return response
+
+@app.route('/report/status/<job_id>')
+@login_required
+def report_status(job_id):
+    job = get_report_job(cache, job_id)
+    if job is None: abort(404)
+    if job["user_id"] != current_user.id: abort(403)
+    if job["status"] == "pending": return jsonify({"status": "pending"}), 202
+    if job["status"] == "failed":
+        discard_report_job(cache, job_id)
+        return jsonify({"status": "failed"}), 500
+    # HEAD is the client's readiness probe; keep the result for the GET that follows
+    if request.method != 'HEAD': discard_report_job(cache, job_id)
+    return send_file(job["path"], mimetype="application/pdf", as_attachment=True, download_name=job["filename"])
 
 @app.route('/api/analytics/student_trend/<int:student_id>')
 @login_required
 def api_student_trend(student_id):
-    student = Student.query.get_or_404(student_id)
-    if current_user.role == UserRole.STUDENT and current_user.student_profile.id != student_id: abort(403)
-    if current_user.role == UserRole.PARENT:
-        if student not in current_user.parent_profile.children: abort(403)
+    # One existence/ownership check per role instead of loading the Student first
+    role = current_user.role
+    if role is UserRole.STUDENT: allowed = current_user.student_profile.id == student_id
+    elif role is UserRole.PARENT: allowed = current_user.parent_profile.has_child(student_id)
+    elif role is UserRole.SUPER_ADMIN: allowed = db.session.query(exists().where(Student.id == student_id)).scalar()
+    else: allowed = db.session.query(exists().where(Student.id == student_id, Student.school_id == current_user.school_id)).scalar()
+    if not allowed: abort(404 if role is UserRole.SUPER_ADMIN else 403)
     data = get_student_grade_trend(student_id)
     return jsonify(data)
 
 @app.route('/api/analytics/class_distribution/<form_num>')
-@login_required
-@role_required(UserRole.SCHOOL_ADMIN)
+@require_school_admin
 def api_class_distribution(form_num):
-    data = get_class_grade_distribution(current_user.school_id, int(form_num))
+    data = cached_class_distribution(current_user.school_id, int(form_num))
     return jsonify(data)
 
 # --- RUN APPLICATION ---
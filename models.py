@@ -4,13 +4,24 @@
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
-from sqlalchemy import Enum
+from sqlalchemy import Enum, case, func, update
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.hybrid import hybrid_property
 import enum
+import numpy as np
+import re
 import uuid
 from datetime import date
+from functools import cached_property
 
 db = SQLAlchemy()
 
+def upsert_insert(model):
+    """An INSERT for model that supports ON CONFLICT clauses on the app's database dialect."""
+    dialect_insert = postgresql_insert if db.engine.dialect.name == 'postgresql' else sqlite_insert
+    return dialect_insert(model)
+
 # --- Enums ---
 
 class UserRole(enum.Enum):
@@ -34,11 +45,24 @@ class AttendanceStatus(enum.Enum):
     LATE = "Late"
     EXCUSED = "Excused"
 
+# Grade letter for each ten-mark band: index = marks // 10, so 0-49 -> F ... 90-100 -> A+
+GRADE_BY_TENS = (GradeLetter.F,) * 5 + (GradeLetter.D, GradeLetter.C, GradeLetter.B, GradeLetter.A, GradeLetter.AP, GradeLetter.AP)
+GRADE_BY_TENS_ARRAY = np.array(GRADE_BY_TENS, dtype=object)
+
+def calculate_grade_letter(marks):
+    return GRADE_BY_TENS[max(0, min(marks, 100)) // 10]
+
+def calculate_grade_letters(marks):
+    """Vectorized calculate_grade_letter: maps an array-like of marks to an array of GradeLetters."""
+    return GRADE_BY_TENS_ARRAY[np.clip(np.asarray(marks, dtype=np.int64), 0, 100) // 10]
+
 # --- Association Table for Parent-Student ---
 
 parent_student_association = db.Table('parent_student_association',
     db.Column('parent_id', db.Integer, db.ForeignKey('parent.id'), primary_key=True),
-    db.Column('student_id', db.Integer, db.ForeignKey('student.id'), primary_key=True)
+    db.Column('student_id', db.Integer, db.ForeignKey('student.id'), primary_key=True),
+    # The primary key serves parent -> children; this serves student -> parents and student deletes
+    db.Index('ix_psa_student', 'student_id')
 )
 
 # --- Core Models ---
@@ -47,16 +71,37 @@ class School(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(150), nullable=False)
     school_code = db.Column(db.String(20), unique=True, nullable=False, index=True)
+    # Next admission sequence number to hand out (see next_admission_sequence below)
+    next_student_seq = db.Column(db.Integer, nullable=False, default=1, server_default='1')
     
-    users = db.relationship('User', back_populates='school', lazy=True)
-    students = db.relationship('Student', back_populates='school', lazy=True)
-    teachers = db.relationship('Teacher', back_populates='school', lazy=True)
-    subjects = db.relationship('Subject', back_populates='school', lazy=True)
-    parents = db.relationship('Parent', back_populates='school', lazy=True)
+    # Dynamic: school.students etc. are queries to filter/count, never whole collections loaded by accident
+    users = db.relationship('User', back_populates='school', lazy='dynamic')
+    students = db.relationship('Student', back_populates='school', lazy='dynamic')
+    teachers = db.relationship('Teacher', back_populates='school', lazy='dynamic')
+    subjects = db.relationship('Subject', back_populates='school', lazy='dynamic')
+    parents = db.relationship('Parent', back_populates='school', lazy='dynamic')
+
+    @cached_property
+    def school_code_base(self):
+        """Admission-number prefix, e.g. "GHS" for school code "GHS@1"."""
+        return self.school_code.split('@')[0]
 
     def __repr__(self):
         return f"<School {self.school_code}>"
 
+def generate_admission_number(school_code_base, student_id, admission_year):
+    # Two-digit year suffix, e.g. 2025 -> "25"
+    return f"{school_code_base}/{student_id:05d}/{admission_year % 100:02d}"
+
+def next_admission_sequence(school_id, count=1):
+    """Atomically claims the next `count` admission sequence numbers for a school and returns the first."""
+    new_next = db.session.execute(
+        update(School).where(School.id == school_id)
+        .values(next_student_seq=School.next_student_seq + count)
+        .returning(School.next_student_seq)
+    ).scalar_one()
+    return new_next - count
+
 class User(db.Model, UserMixin):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(100), unique=True, nullable=False, index=True)
@@ -82,6 +127,11 @@ class User(db.Model, UserMixin):
 # --- School-Specific Data Models ---
 
 class Student(db.Model):
+    __table_args__ = (
+        # A "form" is a (school, admission year) pair: rosters, class reports and distributions filter on both
+        db.Index('ix_student_school_year', 'school_id', 'admission_year'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     full_name = db.Column(db.String(150), nullable=False)
     admission_number = db.Column(db.String(50), unique=True, nullable=False, index=True)
@@ -94,16 +144,16 @@ class Student(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     user = db.relationship('User', back_populates='student_profile')
     
-    school_id = db.Column(db.Integer, db.ForeignKey('school.id'), nullable=False)
+    school_id = db.Column(db.Integer, db.ForeignKey('school.id'), nullable=False, index=True)
     school = db.relationship('School', back_populates='students')
     
     parents = db.relationship('Parent', secondary=parent_student_association, back_populates='children')
     link_code = db.relationship('StudentLinkCode', back_populates='student', uselist=False, cascade="all, delete-orphan")
-    grades = db.relationship('Grade', back_populates='student', lazy='dynamic', cascade="all, delete-orphan")
-    attendance_records = db.relationship('Attendance', back_populates='student', lazy='dynamic', cascade="all, delete-orphan")
+    grades = db.relationship('Grade', back_populates='student', lazy=True, cascade="all, delete-orphan")
+    attendance_records = db.relationship('Attendance', back_populates='student', lazy=True, cascade="all, delete-orphan")
 
     # --- NEW SMART PROPERTY ---
-    @property
+    @hybrid_property
     def form(self):
         """Calculates the student's current form based on admission year."""
         current_year = date.today().year
@@ -114,6 +164,19 @@ class Student(db.Model):
         calculated_form = (current_year - self.admission_year) + 1
         # A student cannot be higher than Form 4
         return min(calculated_form, 4)
+
+    @form.expression
+    def form(cls):
+        """The same calculation in SQL, e.g. for ordering or grouping by form."""
+        calculated_form = (date.today().year - cls.admission_year) + 1
+        return case((calculated_form > 4, 4), else_=calculated_form)
+
+    @classmethod
+    def in_form(cls, form_num):
+        """SQL filter matching `form`, as a range on the indexed admission_year column (prefer over `form ==`)."""
+        admission_year = (date.today().year - form_num) + 1
+        # Form 4 also holds everyone admitted earlier, since `form` is capped at 4
+        return cls.admission_year <= admission_year if form_num >= 4 else cls.admission_year == admission_year
     # --- END NEW ---
 
     def __repr__(self):
@@ -126,11 +189,11 @@ class Teacher(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     user = db.relationship('User', back_populates='teacher_profile')
     
-    school_id = db.Column(db.Integer, db.ForeignKey('school.id'), nullable=False)
+    school_id = db.Column(db.Integer, db.ForeignKey('school.id'), nullable=False, index=True)
     school = db.relationship('School', back_populates='teachers')
     
-    grades_given = db.relationship('Grade', back_populates='teacher', lazy='dynamic')
-    attendance_taken = db.relationship('Attendance', back_populates='teacher', lazy='dynamic')
+    grades_given = db.relationship('Grade', back_populates='teacher', lazy=True)
+    attendance_taken = db.relationship('Attendance', back_populates='teacher', lazy=True)
 
     def __repr__(self):
         return f"<Teacher {self.full_name}>"
@@ -142,11 +205,16 @@ class Parent(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     user = db.relationship('User', back_populates='parent_profile')
     
-    school_id = db.Column(db.Integer, db.ForeignKey('school.id'), nullable=False)
+    school_id = db.Column(db.Integer, db.ForeignKey('school.id'), nullable=False, index=True)
     school = db.relationship('School', back_populates='parents')
     
     children = db.relationship('Student', secondary=parent_student_association, back_populates='parents')
 
+    def has_child(self, student_id):
+        """Checks the link table directly instead of loading the whole children collection."""
+        link = parent_student_association.c
+        return db.session.query(db.exists().where(link.parent_id == self.id, link.student_id == student_id)).scalar()
+
     def __repr__(self):
         return f"<Parent {self.full_name}>"
 
@@ -162,19 +230,41 @@ class Subject(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     
-    school_id = db.Column(db.Integer, db.ForeignKey('school.id'), nullable=False)
+    school_id = db.Column(db.Integer, db.ForeignKey('school.id'), nullable=False, index=True)
     school = db.relationship('School', back_populates='subjects')
     
-    grades = db.relationship('Grade', back_populates='subject', lazy='dynamic')
+    grades = db.relationship('Grade', back_populates='subject', lazy=True)
 
     def __repr__(self):
         return f"<Subject {self.name}>"
 
+TERM_PATTERN = re.compile(r'Term (\d+) (\d{4})')
+
+def term_sort_key(term):
+    """Chronological sort key for a "Term N YYYY" label: 2025 Term 3 -> 20253. Unrecognised labels sort first."""
+    match = TERM_PATTERN.fullmatch(term or '')
+    return int(match[2]) * 10 + int(match[1]) if match else 0
+
 class Grade(db.Model):
+    __table_args__ = (
+        # One grade per student, subject and term; also the conflict target for grade upserts
+        db.Index('ix_grade_lookup', 'student_id', 'subject_id', 'term', unique=True),
+        # Report cards and dashboards read one student's grades for a term
+        db.Index('ix_grade_student_term', 'student_id', 'term'),
+        # Per-subject results for a term (subject averages), and subject deletes
+        db.Index('ix_grade_subject_term', 'subject_id', 'term'),
+        # Trend charts walk one student's terms in chronological order
+        db.Index('ix_grade_student_term_order', 'student_id', 'term_order'),
+        # Covers the class grade distribution: letters are counted straight from the index
+        db.Index('ix_grade_student_letter', 'student_id', 'grade_letter'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     marks = db.Column(db.Integer, nullable=False)
     grade_letter = db.Column(Enum(GradeLetter), nullable=False)
     term = db.Column(db.String(50), nullable=False)
+    # Derived from `term` on insert, since the label itself sorts "Term 1 2026" before "Term 2 2025"
+    term_order = db.Column(db.Integer, nullable=False, default=lambda context: term_sort_key(context.get_current_parameters()['term']))
     
     student_id = db.Column(db.Integer, db.ForeignKey('student.id'), nullable=False)
     subject_id = db.Column(db.Integer, db.ForeignKey('subject.id'), nullable=False)
@@ -187,7 +277,22 @@ class Grade(db.Model):
     def __repr__(self):
         return f"<Grade {self.student.full_name} - {self.subject.name}: {self.marks}>"
 
+class SchoolMetric(db.Model):
+    """Per-school grade aggregates, kept current by utils.analytics.refresh_school_metrics."""
+    school_id = db.Column(db.Integer, db.ForeignKey('school.id'), primary_key=True)
+    grade_count = db.Column(db.Integer, nullable=False, default=0)
+    average_score = db.Column(db.Float)
+    updated_at = db.Column(db.DateTime, nullable=False, server_default=func.now())
+
+    def __repr__(self):
+        return f"<SchoolMetric {self.school_id}: {self.average_score}>"
+
 class Attendance(db.Model):
+    __table_args__ = (
+        # One mark per student per day; also the conflict target for roster upserts
+        db.Index('ix_attendance_date_student', 'date', 'student_id', unique=True),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     date = db.Column(db.Date, nullable=False, default=date.today)
     status = db.Column(Enum(AttendanceStatus), nullable=False)
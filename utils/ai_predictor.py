@@ -3,22 +3,37 @@
 # These are simple rule-based placeholders.
 # For a real app, you'd plug in an OpenAI/Gemini API or a trained model.
 
-from models import db, Grade
+from models import db, Grade, Subject
+from sqlalchemy import asc, desc, select
+from sqlalchemy.orm import aliased
 from sqlalchemy.sql import func
-import random
+import numpy as np
 
-def generate_ai_remark(grades_list):
+def _subject_at(student_id, term, direction):
+    """Scalar subquery: the subject name at the top of the term's marks ordered by `direction`."""
+    ranked = aliased(Grade) # Own alias so it isn't correlated with the outer Grade query
+    return select(Subject.name).join(ranked, ranked.subject_id == Subject.id).where(
+        ranked.student_id == student_id, ranked.term == term
+    ).order_by(direction(ranked.marks), ranked.id).limit(1).scalar_subquery()
+
+def generate_term_remark(student_id, term):
     """
-    Generates a simple, rule-based summary remark for a report card.
+    Generates a simple, rule-based summary remark for a student's report card.
+
+    The average and strongest/weakest subjects are aggregated in SQL, so no
+    Grade rows are loaded.
     """
-    if not grades_list:
+    count, avg_mark, max_mark, min_mark, strongest_name, weakest_name = db.session.execute(
+        select(
+            func.count(Grade.id), func.avg(Grade.marks), func.max(Grade.marks), func.min(Grade.marks),
+            _subject_at(student_id, term, desc), _subject_at(student_id, term, asc)
+        ).where(Grade.student_id == student_id, Grade.term == term)
+    ).one()
+    if not count:
         return "No grades available for this term."
-        
-    avg_mark = sum(g.marks for g in grades_list) / len(grades_list)
-    
-    strongest_subject = max(grades_list, key=lambda g: g.marks)
-    weakest_subject = min(grades_list, key=lambda g: g.marks)
-    
+    return _compose_remark(avg_mark, strongest_name, max_mark, weakest_name, min_mark)
+
+def _compose_remark(avg_mark, strongest_name, strongest_marks, weakest_name, weakest_marks):
     remark = f"Overall performance this term was "
     if avg_mark >= 80:
         remark += f"excellent, with an average of {avg_mark:.1f}%. "
@@ -29,20 +44,20 @@ def generate_ai_remark(grades_list):
     else:
         remark += f"below average, with an average of {avg_mark:.1f}%. Needs improvement. "
         
-    if strongest_subject.marks > 85:
-        remark += f"Outstanding work in {strongest_subject.subject.name} ({strongest_subject.marks}%). "
+    if strongest_marks > 85:
+        remark += f"Outstanding work in {strongest_name} ({strongest_marks}%). "
         
-    if weakest_subject.marks < 50:
-        remark += f"Significant focus is required in {weakest_subject.subject.name} ({weakest_subject.marks}%)."
-    elif weakest_subject.marks < 60 and avg_mark > 70:
-         remark += f"Consider extra practice in {weakest_subject.subject.name} to match overall performance."
+    if weakest_marks < 50:
+        remark += f"Significant focus is required in {weakest_name} ({weakest_marks}%)."
+    elif weakest_marks < 60 and avg_mark > 70:
+         remark += f"Consider extra practice in {weakest_name} to match overall performance."
 
     return remark
 
 def predict_next_term(student_id):
     """
-    (Placeholder) Predicts next term's average based on a simple trend.
-    A real implementation would use linear regression or a time-series model.
+    (Placeholder) Predicts next term's average from a linear fit over the term averages.
+    A real implementation would use a proper time-series model.
     """
     # Get average marks for all terms
     trend_data = db.session.query(
@@ -51,26 +66,20 @@ def predict_next_term(student_id):
     ).filter(
         Grade.student_id == student_id
     ).group_by(
-        Grade.term
+        Grade.term_order, Grade.term
     ).order_by(
-        Grade.term
+        Grade.term_order, Grade.term
     ).all()
     
     if len(trend_data) < 2:
         return "Not enough data to predict future performance."
         
-    # Simple linear trend: (last_avg - first_avg) / num_terms
+    # Least-squares linear trend across every term, not just the first and last
     try:
-        last_avg = trend_data[-1].average_marks
-        first_avg = trend_data[0].average_marks
-        num_terms = len(trend_data)
-        
-        avg_change_per_term = (last_avg - first_avg) / (num_terms - 1)
-        
-        prediction = last_avg + avg_change_per_term
+        averages = np.array([row.average_marks for row in trend_data], dtype=float)
+        avg_change_per_term, intercept = np.polyfit(np.arange(len(averages)), averages, 1)
         
-        # Add some noise for realism
-        prediction += random.uniform(-2, 2)
+        prediction = intercept + avg_change_per_term * len(averages)
         
         if prediction > 100: prediction = 100
         if prediction < 0: prediction = 0
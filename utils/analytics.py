@@ -1,23 +1,30 @@
 # utils/analytics.py
 # Functions to query the DB and structure data for Chart.js and analytics.
 
-from models import db, Student, Grade, School, UserRole
+from models import db, Student, Grade, GradeLetter, School, SchoolMetric, UserRole, upsert_insert
+from sqlalchemy import select
 from sqlalchemy.sql import func
 import pandas as pd
-from datetime import date # <-- NEW IMPORT
+
+# Hot chart queries use Core selects on the tables: the results are plain
+# aggregate tuples, so they skip the ORM's entity and attribute machinery.
+grade_table, student_table, school_table = Grade.__table__, Student.__table__, School.__table__
+metric_table = SchoolMetric.__table__
 
 def get_student_grade_trend(student_id):
     """Fetches average marks per term for a specific student."""
     
-    trend_data = db.session.query(
-        Grade.term,
-        func.avg(Grade.marks).label('average_marks')
-    ).filter(
-        Grade.student_id == student_id
-    ).group_by(
-        Grade.term
-    ).order_by(
-        Grade.term
+    trend_data = db.session.execute(
+        select(
+            grade_table.c.term,
+            func.avg(grade_table.c.marks).label('average_marks')
+        ).where(
+            grade_table.c.student_id == student_id
+        ).group_by(
+            grade_table.c.term_order, grade_table.c.term
+        ).order_by(
+            grade_table.c.term_order, grade_table.c.term
+        )
     ).all()
     
     if not trend_data:
@@ -34,27 +41,26 @@ def get_student_grade_trend(student_id):
 def get_class_grade_distribution(school_id, form_num):
     """Calculates the distribution of grades (A, B, C...) for a form."""
     
-    # --- NEW LOGIC ---
-    # We can't query by 'form' anymore, as it's a property.
-    # We must calculate the required admission_year.
-    current_year = date.today().year
-    required_admission_year = (current_year - form_num) + 1
-    # --- END NEW LOGIC ---
-
-    grades = db.session.query(
-        Grade.grade_letter
-    ).join(Student).filter(
-        Student.school_id == school_id,
-        Student.admission_year == required_admission_year # <-- UPDATED QUERY
+    # We can't query by 'form' anymore, as it's a property;
+    # Student.in_form() translates it to an admission_year range.
+    # The database counts per letter; only one row per letter comes back
+    letter_counts = db.session.execute(
+        select(
+            grade_table.c.grade_letter, func.count()
+        ).join(
+            student_table, student_table.c.id == grade_table.c.student_id
+        ).where(
+            student_table.c.school_id == school_id,
+            Student.in_form(form_num)
+        ).group_by(
+            grade_table.c.grade_letter
+        )
     ).all()
     
-    distribution = {
-        'A+': 0, 'A': 0, 'B': 0, 'C': 0, 'D': 0, 'F': 0
-    }
-    for grade in grades:
-        key = grade.grade_letter.name.replace("AP", "A+")
-        if key in distribution:
-            distribution[key] += 1
+    # Enum values are the display labels ('A+', 'A', ...), in chart order
+    distribution = dict.fromkeys((letter.value for letter in GradeLetter), 0)
+    for grade_letter, count in letter_counts:
+        distribution[grade_letter.value] += count
             
     labels = list(distribution.keys())
     data = list(distribution.values())
@@ -69,20 +75,50 @@ def get_subject_averages(school_id, form):
     # (Implementation would be similar to get_student_grade_trend)
     pass
 
+def refresh_school_metrics(school_id=None):
+    """
+    Recomputes the SchoolMetric rows from the grades table.
+
+    Pass the school whose grades changed to refresh just that row; with no
+    argument every school is rebuilt. The caller commits.
+    """
+    query = select(
+        student_table.c.school_id,
+        func.count(grade_table.c.id),
+        func.avg(grade_table.c.marks)
+    ).join(
+        grade_table, student_table.c.id == grade_table.c.student_id
+    ).group_by(
+        student_table.c.school_id
+    )
+    if school_id is not None:
+        query = query.where(student_table.c.school_id == school_id)
+
+    rows = [
+        {"school_id": sid, "grade_count": count, "average_score": average}
+        for sid, count, average in db.session.execute(query)
+    ]
+    if rows:
+        stmt = upsert_insert(SchoolMetric).values(rows)
+        db.session.execute(stmt.on_conflict_do_update(index_elements=['school_id'], set_={
+            "grade_count": stmt.excluded.grade_count, "average_score": stmt.excluded.average_score, "updated_at": func.now()
+        }))
+
 def get_school_comparison():
     """(Bonus) Generates data for Super Admin to compare schools."""
     
-    query = db.session.query(
-        School.name,
-        func.avg(Grade.marks).label('average_score')
-    ).join(
-        Student, School.id == Student.school_id
-    ).join(
-        Grade, Student.id == Grade.student_id
-    ).group_by(
-        School.name
-    ).order_by(
-        func.avg(Grade.marks).desc()
+    # Read the prebuilt per-school averages instead of aggregating every grade (ensure_db backfills them)
+    query = db.session.execute(
+        select(
+            school_table.c.name,
+            metric_table.c.average_score
+        ).join(
+            metric_table, school_table.c.id == metric_table.c.school_id
+        ).where(
+            metric_table.c.grade_count > 0
+        ).order_by(
+            metric_table.c.average_score.desc()
+        )
     ).all()
     
     labels = [row.name for row in query]
@@ -1,10 +1,84 @@
 # utils/bulk_importer.py
 # Contains all logic for processing bulk file uploads.
 
+import os
+import numpy as np
 import pandas as pd
-from models import db, Subject, Student, User, School, UserRole
+from concurrent.futures import ThreadPoolExecutor
+from models import db, Subject, Student, User, School, UserRole, generate_admission_number, next_admission_sequence
 # from app import generate_admission_number # <-- DELETED FROM HERE
+from sqlalchemy import insert, select
 from sqlalchemy.exc import IntegrityError
+from werkzeug.security import generate_password_hash
+
+# Large uploads are written and committed this many rows at a time, so one file
+# never holds the write lock for the whole import
+IMPORT_CHUNK_SIZE = 1000
+
+def _chunks(rows, size=IMPORT_CHUNK_SIZE):
+    """Yields consecutive slices of `rows`, each at most `size` long."""
+    for start in range(0, len(rows), size):
+        yield rows[start:start + size]
+
+# Password hashing is deliberately slow and CPU-bound, so on a big upload it outweighs
+# everything else. werkzeug's scrypt/pbkdf2 run in hashlib's C code with the GIL
+# released, so plain threads hash on every core; shared by all uploads in this process.
+_hash_executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix='password-hash')
+# Below this many passwords, handing them to the threads costs more than it saves
+PARALLEL_HASH_MIN = 16
+
+def _hash_passwords(passwords):
+    """Hashes each password, spread over the hashing threads for larger batches."""
+    if len(passwords) < PARALLEL_HASH_MIN:
+        return [generate_password_hash(password) for password in passwords]
+    return list(_hash_executor.map(generate_password_hash, passwords))
+
+def _read_upload(file_storage, columns):
+    """
+    Reads an uploaded sheet, keeping only the columns the importer uses.
+
+    pandas' openpyxl reader already streams the workbook in read-only mode;
+    usecols stops any extra columns in the user's file from being
+    materialized. Missing columns are left for the caller to report.
+    """
+    try:
+        return pd.read_excel(file_storage, engine='openpyxl', usecols=lambda col: col in columns)
+    except Exception as e:
+        raise ValueError(f"Could not read Excel file. Error: {e}")
+
+def _strip_text(df, cols):
+    """Strips surrounding whitespace from the text columns in one pass each; blanks stay <NA>."""
+    for col in cols:
+        df[col] = df[col].astype('string').str.strip()
+
+def _blank_mask(df, cols):
+    """Row mask, computed once per file: True where any of `cols` is missing or only whitespace."""
+    stripped = df[cols].astype(str).apply(lambda col: col.str.strip())
+    return (df[cols].isna() | (stripped == '')).any(axis=1).to_numpy()
+
+def _repeats(values, eligible):
+    """
+    Row mask: True where an earlier *eligible* row has the same value.
+
+    Eligible rows are the ones that pass every other check, so the first of
+    them is the copy that gets imported. Earlier copies that were rejected
+    for something else don't count, matching a row-by-row "already seen in
+    this file" check, but in one grouped pass.
+    """
+    positions = pd.Series(np.arange(len(values)), index=values.index)
+    first_eligible = positions[eligible].groupby(values[eligible]).min()
+    return (values.map(first_eligible) < positions).to_numpy()
+
+def _incoming_values(df, col):
+    """Distinct non-blank values of an already-stripped column in the upload."""
+    values = df[col].dropna()
+    return values[values != ''].unique().tolist()
+
+def _taken(column, values):
+    """The subset of `values` already present in `column`, via one IN query."""
+    if not values:
+        return set()
+    return set(db.session.scalars(select(column).where(column.in_(values))))
 
 def process_subject_upload(file_storage, school_id):
     """
@@ -13,43 +87,50 @@ def process_subject_upload(file_storage, school_id):
     Returns:
         dict: A report of added, skipped, and error items.
     """
-    try:
-        df = pd.read_excel(file_storage)
-    except Exception as e:
-        raise ValueError(f"Could not read Excel file. Error: {e}")
+    df = _read_upload(file_storage, ['SubjectName'])
 
     if 'SubjectName' not in df.columns:
         raise ValueError("Invalid file format. Missing required column: 'SubjectName'")
 
+    _strip_text(df, ['SubjectName'])
+    # Lowercased once for the case-insensitive duplicate checks
+    lowered = df['SubjectName'].str.lower()
+
+    # Already scoped to one school (a few dozen names), so just fetch the name column;
+    # lowercasing stays in Python, which folds non-ASCII case that SQLite's lower() doesn't
     existing_subjects = {
-        s.name.lower() for s in Subject.query.filter_by(school_id=school_id).all()
+        name.lower() for name in db.session.scalars(select(Subject.name).where(Subject.school_id == school_id))
     }
     
     report = {"added": 0, "skipped": 0, "errors": []}
+    new_subjects = []
+    
+    # itertuples yields lightweight namedtuples instead of building a Series per row
+    blank = _blank_mask(df, ['SubjectName'])
+    # Taken if the school has it already, or an earlier importable row of this file repeats it
+    in_db = lowered.isin(existing_subjects).to_numpy()
+    taken = in_db | _repeats(lowered, ~blank & ~in_db)
     
-    for index, row in df.iterrows():
-        subject_name = str(row['SubjectName']).strip()
+    for pos, row in enumerate(df.itertuples(index=True)):
+        index = row.Index
+        subject_name = row.SubjectName
         
-        if not subject_name or pd.isna(row['SubjectName']):
+        if blank[pos]:
             report["skipped"] += 1
             report["errors"].append(f"Row {index+2}: SubjectName is blank.")
             continue
             
-        if subject_name.lower() in existing_subjects:
+        if taken[pos]:
             report["skipped"] += 1
             report["errors"].append(f"Row {index+2}: Subject '{subject_name}' already exists.")
             continue
             
-        try:
-            new_subject = Subject(name=subject_name, school_id=school_id)
-            db.session.add(new_subject)
-            existing_subjects.add(subject_name.lower())
-            report["added"] += 1
-        except Exception as e:
-            report["skipped"] += 1
-            report["errors"].append(f"Row {index+2}: Error adding '{subject_name}'. {e}")
+        new_subjects.append({"name": subject_name, "school_id": school_id})
+        report["added"] += 1
 
     try:
+        if new_subjects:
+            db.session.execute(insert(Subject), new_subjects)
         db.session.commit()
     except IntegrityError as e:
         db.session.rollback()
@@ -68,88 +149,85 @@ def process_student_upload(file_storage, school):
     Returns:
         dict: A report of added, skipped, and error items.
     """
-    
-    # Import moved inside to break circular dependency
-    from app import generate_admission_number 
-
-    try:
-        df = pd.read_excel(file_storage)
-    except Exception as e:
-        raise ValueError(f"Could not read Excel file. Error: {e}")
-
     required_cols = ['FullName', 'AdmissionYear', 'LoginUsername', 'InitialPassword']
+    df = _read_upload(file_storage, required_cols)
     if not all(col in df.columns for col in required_cols):
         raise ValueError(f"Invalid file format. Missing one or more required columns: {required_cols}")
+    _strip_text(df, ['FullName', 'LoginUsername', 'InitialPassword'])
 
-    existing_usernames = {u.username for u in User.query.all()}
-    student_count = Student.query.filter_by(school_id=school.id).count()
-    school_code_base = school.school_code.split('@')[0]
+    existing_usernames = _taken(User.username, _incoming_values(df, 'LoginUsername'))
+    school_code_base = school.school_code_base
     
     report = {"added": 0, "skipped": 0, "errors": []}
-    new_users_in_file = [] # To track usernames in *this file*
+    valid_rows = [] # (full_name, adm_year, username, password) for rows that passed validation
     
-    for index, row in df.iterrows():
-        full_name = str(row['FullName']).strip()
-        adm_year = row['AdmissionYear']
-        username = str(row['LoginUsername']).strip()
-        password = str(row['InitialPassword']).strip()
+    # Column-wide checks run once per file; the loop just looks them up by position
+    blank = _blank_mask(df, required_cols)
+    short_password = (df['InitialPassword'].str.len().fillna(0) < 6).to_numpy()
+    # Whole column to numbers at once; text, fractions and out-of-range years are all flagged bad
+    years = pd.to_numeric(df['AdmissionYear'], errors='coerce')
+    bad_year = (~years.between(2000, 2100) | (years % 1 != 0)).to_numpy()
+    years = years.fillna(0).astype(int).to_numpy()
+    in_db = df['LoginUsername'].isin(existing_usernames).to_numpy()
+    # Repeats of a username that an earlier row of this file will already import
+    dup_username = _repeats(df['LoginUsername'], ~blank & ~bad_year & ~in_db & ~short_password)
+    
+    for pos, row in enumerate(df.itertuples(index=True)):
+        index = row.Index
+        full_name = row.FullName
+        username = row.LoginUsername
+        password = row.InitialPassword
         
-        if any(pd.isna(row[col]) for col in required_cols) or not all([full_name, adm_year, username, password]):
+        if blank[pos]:
             report["skipped"] += 1
             report["errors"].append(f"Row {index+2}: One or more cells are blank.")
             continue
         
-        try:
-            adm_year = int(adm_year)
-            if not (2000 <= adm_year <= 2100):
-                raise ValueError("Year must be 4 digits.")
-        except ValueError:
+        if bad_year[pos]:
             report["skipped"] += 1
             report["errors"].append(f"Row {index+2}: 'AdmissionYear' must be a 4-digit number (e.g., 2025).")
             continue
+        adm_year = int(years[pos])
             
-        if username in existing_usernames or username in new_users_in_file:
+        if in_db[pos] or dup_username[pos]:
             report["skipped"] += 1
             report["errors"].append(f"Row {index+2}: Username '{username}' is already taken.")
             continue
         
-        if len(password) < 6:
+        if short_password[pos]:
             report["skipped"] += 1
             report["errors"].append(f"Row {index+2}: Password for '{username}' must be at least 6 characters.")
             continue
         
-        try:
-            # 1. Create User
-            new_user = User(username=username, role=UserRole.STUDENT, school_id=school.id)
-            new_user.set_password(password)
-            db.session.add(new_user)
-            db.session.flush() 
-            
-            # 2. Create Admission Number
-            student_count += 1
-            year_str = str(adm_year)[-2:]
-            adm_num = generate_admission_number(school_code_base, student_count, year_str)
-            
-            # 3. Create Student
-            new_student = Student(full_name=full_name, admission_number=adm_num, admission_year=adm_year, user_id=new_user.id, school_id=school.id)
-            db.session.add(new_student)
-            
-            new_users_in_file.append(username)
-            report["added"] += 1
-
-        except Exception as e:
-            db.session.rollback() 
-            report["skipped"] += 1
-            report["errors"].append(f"Row {index+2}: Error for '{username}'. {e}")
+        valid_rows.append((full_name, adm_year, username, password))
 
     try:
-        db.session.commit()
+        for chunk in _chunks(valid_rows):
+            password_hashes = _hash_passwords([password for _, _, _, password in chunk])
+            # 1. Create Users in one batch; RETURNING hands back their ids
+            user_ids = dict(db.session.execute(
+                insert(User).returning(User.username, User.id),
+                [{"username": username, "password_hash": password_hash, "role": UserRole.STUDENT, "school_id": school.id}
+                 for (_, _, username, _), password_hash in zip(chunk, password_hashes)]
+            ).all())
+            
+            # 2. Claim a consecutive block of admission numbers in one UPDATE
+            first_seq = next_admission_sequence(school.id, len(chunk))
+            
+            # 3. Create Students in one batch
+            db.session.execute(insert(Student), [
+                {"full_name": full_name, "admission_number": generate_admission_number(school_code_base, first_seq + offset, adm_year),
+                 "admission_year": adm_year, "user_id": user_ids[username], "school_id": school.id}
+                for offset, (full_name, adm_year, username, _) in enumerate(chunk)
+            ])
+            db.session.commit() # Each chunk is saved on its own
+            report["added"] += len(chunk)
     except IntegrityError as e:
         db.session.rollback()
-        raise ValueError(f"Database error. This may be due to duplicate data. {e}")
+        raise ValueError(f"Database error after {report['added']} students were saved. This may be due to duplicate data. {e}")
     except Exception as e:
         db.session.rollback()
-        raise ValueError(f"An unknown error occurred. {e}")
+        raise ValueError(f"An unknown error occurred after {report['added']} students were saved. {e}")
 
     return report
 
@@ -161,86 +239,83 @@ def process_school_upload(file_storage):
     Returns:
         dict: A report of added, skipped, and error items.
     """
-    try:
-        df = pd.read_excel(file_storage)
-    except Exception as e:
-        raise ValueError(f"Could not read Excel file. Error: {e}")
-
     required_cols = ['SchoolName', 'SchoolCode', 'AdminUsername', 'AdminPassword']
+    df = _read_upload(file_storage, required_cols)
     if not all(col in df.columns for col in required_cols):
         raise ValueError(f"Invalid file format. Missing one or more required columns: {required_cols}")
+    _strip_text(df, required_cols)
 
     # Get existing data to prevent duplicates
-    existing_school_codes = {s.school_code for s in School.query.all()}
-    existing_usernames = {u.username for u in User.query.all()}
+    # Only the codes and usernames that appear in this file are looked up
+    existing_school_codes = _taken(School.school_code, _incoming_values(df, 'SchoolCode'))
+    existing_usernames = _taken(User.username, _incoming_values(df, 'AdminUsername'))
     
     report = {"added": 0, "skipped": 0, "errors": []}
-    new_codes_in_file = []
-    new_users_in_file = []
+    valid_rows = [] # (school_name, school_code, admin_user, admin_pass) for rows that passed validation
+    
+    # Column-wide checks run once per file; the loop just looks them up by position
+    blank = _blank_mask(df, required_cols)
+    short_password = (df['AdminPassword'].str.len().fillna(0) < 6).to_numpy()
+    # Codes and usernames of rows already accepted from this file. A row claims both only if
+    # it passes every check, and either rejection depends on earlier claims of the other,
+    # so this stays a row-by-row pass (on hash sets, so still linear)
+    codes_in_file = set()
+    users_in_file = set()
     
-    for index, row in df.iterrows():
-        school_name = str(row['SchoolName']).strip()
-        school_code = str(row['SchoolCode']).strip()
-        admin_user = str(row['AdminUsername']).strip()
-        admin_pass = str(row['AdminPassword']).strip()
+    for pos, row in enumerate(df.itertuples(index=True)):
+        index = row.Index
+        school_name = row.SchoolName
+        school_code = row.SchoolCode
+        admin_user = row.AdminUsername
+        admin_pass = row.AdminPassword
 
         # --- Data Validation ---
-        if any(pd.isna(row[col]) for col in required_cols) or not all([school_name, school_code, admin_user, admin_pass]):
+        if blank[pos]:
             report["skipped"] += 1
             report["errors"].append(f"Row {index+2}: One or more cells are blank.")
             continue
         
-        if school_code in existing_school_codes or school_code in new_codes_in_file:
+        if school_code in existing_school_codes or school_code in codes_in_file:
             report["skipped"] += 1
             report["errors"].append(f"Row {index+2}: SchoolCode '{school_code}' is already taken.")
             continue
             
-        if admin_user in existing_usernames or admin_user in new_users_in_file:
+        if admin_user in existing_usernames or admin_user in users_in_file:
             report["skipped"] += 1
             report["errors"].append(f"Row {index+2}: AdminUsername '{admin_user}' is already taken.")
             continue
             
-        if len(admin_pass) < 6:
+        if short_password[pos]:
             report["skipped"] += 1
             report["errors"].append(f"Row {index+2}: Password for '{admin_user}' must be at least 6 characters.")
             continue
         
-        # --- Passed Validation: Create Objects ---
-        try:
-            # 1. Create School
-            new_school = School(
-                name=school_name,
-                school_code=school_code
-            )
-            db.session.add(new_school)
-            db.session.flush() # Get new_school.id
-
-            # 2. Create School Admin User
-            new_admin = User(
-                username=admin_user,
-                role=UserRole.SCHOOL_ADMIN,
-                school_id=new_school.id
-            )
-            new_admin.set_password(admin_pass)
-            db.session.add(new_admin)
-            
-            # Add to local tracking
-            new_codes_in_file.append(school_code)
-            new_users_in_file.append(admin_user)
-            report["added"] += 1
-
-        except Exception as e:
-            db.session.rollback() # Rollback this specific school/admin pair
-            report["skipped"] += 1
-            report["errors"].append(f"Row {index+2}: Error for '{school_code}'. {e}")
+        # --- Passed Validation: queue the school/admin pair ---
+        codes_in_file.add(school_code)
+        users_in_file.add(admin_user)
+        valid_rows.append((school_name, school_code, admin_user, admin_pass))
 
     try:
-        db.session.commit() # Commit all successful schools at once
+        for chunk in _chunks(valid_rows):
+            password_hashes = _hash_passwords([admin_pass for _, _, _, admin_pass in chunk])
+            # 1. Create Schools in one batch; RETURNING hands back their ids
+            school_ids = dict(db.session.execute(
+                insert(School).returning(School.school_code, School.id),
+                [{"name": school_name, "school_code": school_code} for school_name, school_code, _, _ in chunk]
+            ).all())
+
+            # 2. Create School Admin Users in one batch
+            db.session.execute(insert(User), [
+                {"username": admin_user, "password_hash": password_hash, "role": UserRole.SCHOOL_ADMIN, "school_id": school_ids[school_code]}
+                for (_, school_code, admin_user, _), password_hash in zip(chunk, password_hashes)
+            ])
+            db.session.commit() # Commit each chunk of schools with its admins
+            report["added"] += len(chunk)
     except IntegrityError as e:
         db.session.rollback()
-        raise ValueError(f"Database error. This may be due to duplicate data. {e}")
+        raise ValueError(f"Database error after {report['added']} schools were saved. This may be due to duplicate data. {e}")
     except Exception as e:
         db.session.rollback()
-        raise ValueError(f"An unknown error occurred. {e}")
+        raise ValueError(f"An unknown error occurred after {report['added']} schools were saved. {e}")
 
     return report
\ No newline at end of file
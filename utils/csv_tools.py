@@ -2,30 +2,50 @@
 # Utility to load mock data from CSVs into the SQLite database.
 
 import pandas as pd
-from models import db, School, User, Student, Teacher, Subject, Grade, UserRole
+from models import (
+    db, School, User, Student, Teacher, Subject, Grade, UserRole,
+    calculate_grade_letters, generate_admission_number
+)
+from sqlalchemy import insert, select, update
+from werkzeug.security import generate_password_hash
 from datetime import datetime
+from utils.analytics import refresh_school_metrics
 
 DATA_DIR = 'data'
 
 def load_data_from_csv():
-    """Loads all mock data from CSV files into the database."""
+    """
+    Loads all mock data from CSV files into the database.
+    
+    Rows are collected into plain dicts and written with one Core INSERT per
+    table (SQLAlchemy's executemany fast path) instead of an ORM object and
+    flush per row. Everything is committed as a single transaction.
+    """
     try:
-        # We move the import inside the function to break circular imports
-        from app import calculate_grade_letter, generate_admission_number
+        conn = db.session.connection()
+        if conn.dialect.name == 'sqlite':
+            # Check foreign keys once at the final commit rather than per inserted row;
+            # SQLite switches this back off by itself when the transaction ends
+            conn.exec_driver_sql("PRAGMA defer_foreign_keys=ON")
 
         # 1. Load Schools
-        schools_df = pd.read_csv(f'{DATA_DIR}/schools.csv')
-        for _, row in schools_df.iterrows():
-            school = School(name=row['name'], school_code=row['school_code'])
-            db.session.add(school)
-        db.session.commit()
+        # Each CSV is parsed with explicit column types, so pandas skips dtype inference
+        schools_df = pd.read_csv(f'{DATA_DIR}/schools.csv', usecols=['name', 'school_code'], dtype='string', engine='c')
+        db.session.execute(insert(School), schools_df[['name', 'school_code']].to_dict('records'))
         print("Schools loaded.")
 
-        school_map = {s.school_code: s.id for s in School.query.all()}
+        school_map = dict(db.session.execute(select(School.school_code, School.id)).all())
         
         # 2. Load Users (and their profiles)
-        users_df = pd.read_csv(f'{DATA_DIR}/users.csv').fillna('')
+        users_df = pd.read_csv(f'{DATA_DIR}/users.csv', engine='c', dtype={
+            'username': 'string', 'password': 'string', 'role': 'category',
+            'school_code': 'string', 'full_name': 'string', 'admission_year': 'Int64'
+        })
+        users_df[['school_code', 'full_name']] = users_df[['school_code', 'full_name']].fillna('')
         student_id_counter = {} 
+        user_records = []
+        student_records = []
+        teacher_records = []
         
         for _, row in users_df.iterrows():
             role = UserRole(row['role'])
@@ -35,16 +55,14 @@ def load_data_from_csv():
                 print(f"Skipping user {row['username']} - school code {row['school_code']} not found.")
                 continue
 
-            user = User(
-                username=row['username'],
-                role=role,
-                school_id=school_id
-            )
-            user.set_password(row['password'])
-            db.session.add(user)
-            db.session.flush() 
+            user_records.append({
+                "username": row['username'],
+                "password_hash": generate_password_hash(row['password']),
+                "role": role,
+                "school_id": school_id
+            })
 
-            # Create profiles
+            # Profiles are keyed by username until the user ids exist
             if role == UserRole.STUDENT:
                 school_code_base = row['school_code'].split('@')[0]
                 
@@ -52,82 +70,104 @@ def load_data_from_csv():
                     student_id_counter[school_code_base] = 0
                 student_id_counter[school_code_base] += 1
                 
-                # --- NEW LOGIC ---
                 adm_year = int(row['admission_year'])
-                year_str = str(adm_year)[-2:] # e.g., 2025 -> "25"
                 
                 adm_num = generate_admission_number(
                     school_code_base,
                     student_id_counter[school_code_base],
-                    year_str  # Pass the 2-digit year string
+                    adm_year
                 )
                 
-                student = Student(
-                    full_name=row['full_name'],
-                    admission_number=adm_num,
-                    admission_year=adm_year, # Store the full admission year
-                    user_id=user.id,
-                    school_id=school_id
-                )
-                # --- END NEW LOGIC ---
-                db.session.add(student)
+                student_records.append({
+                    "full_name": row['full_name'],
+                    "admission_number": adm_num,
+                    "admission_year": adm_year, # Store the full admission year
+                    "username": row['username'],
+                    "school_id": school_id
+                })
             
             elif role == UserRole.TEACHER:
-                teacher = Teacher(
-                    full_name=row['full_name'],
-                    user_id=user.id,
-                    school_id=school_id
-                )
-                db.session.add(teacher)
+                teacher_records.append({
+                    "full_name": row['full_name'],
+                    "username": row['username'],
+                    "school_id": school_id
+                })
         
-        db.session.commit()
+        db.session.execute(insert(User), user_records)
+        user_map = dict(db.session.execute(select(User.username, User.id)).all())
+        for profiles, model in ((student_records, Student), (teacher_records, Teacher)):
+            for record in profiles:
+                record["user_id"] = user_map[record.pop("username")]
+            if profiles:
+                db.session.execute(insert(model), profiles)
+        
+        # Continue each school's admission sequence after the seeded students
+        db.session.execute(update(School), [
+            {"id": school_id, "next_student_seq": student_id_counter.get(code.split('@')[0], 0) + 1}
+            for code, school_id in school_map.items()
+        ])
         print("Users, Students, and Teachers loaded.")
 
         # 3. Load Subjects
-        subjects_df = pd.read_csv(f'{DATA_DIR}/subjects.csv')
-        for _, row in subjects_df.iterrows():
-            school_id = school_map.get(row['school_code'])
-            if school_id:
-                subject = Subject(name=row['name'], school_id=school_id)
-                db.session.add(subject)
-        db.session.commit()
+        subjects_df = pd.read_csv(f'{DATA_DIR}/subjects.csv', usecols=['name', 'school_code'], dtype='string', engine='c')
+        subject_records = [
+            {"name": row['name'], "school_id": school_map[row['school_code']]}
+            for _, row in subjects_df.iterrows() if row['school_code'] in school_map
+        ]
+        if subject_records:
+            db.session.execute(insert(Subject), subject_records)
         print("Subjects loaded.")
 
-        student_map = {s.admission_number: s.id for s in Student.query.all()}
-        subject_map = {(s.name, s.school_id): s.id for s in Subject.query.all()}
-        teacher_map = {u.username: u.teacher_profile.id for u in User.query.filter_by(role=UserRole.TEACHER).all() if u.teacher_profile}
+        # Column-only queries for the lookup maps, no ORM objects
+        student_map = {
+            adm_num: (student_id, school_id)
+            for adm_num, student_id, school_id in db.session.execute(select(Student.admission_number, Student.id, Student.school_id))
+        }
+        subject_map = {
+            (name, school_id): subject_id
+            for name, school_id, subject_id in db.session.execute(select(Subject.name, Subject.school_id, Subject.id))
+        }
+        # One JOIN instead of a lazy teacher_profile load per teacher user
+        teacher_map = dict(db.session.execute(
+            select(User.username, Teacher.id).join(Teacher, Teacher.user_id == User.id).where(User.role == UserRole.TEACHER)
+        ).all())
 
         # 4. Load Grades
-        grades_df = pd.read_csv(f'{DATA_DIR}/grades.csv')
+        grades_df = pd.read_csv(f'{DATA_DIR}/grades.csv', engine='c', dtype={
+            'student_admission_number': 'string', 'subject_name': 'string',
+            'teacher_username': 'string', 'term': 'category', 'marks': 'int32'
+        })
+        # Letters for every row in one vectorized lookup instead of a call per grade
+        grades_df['grade_letter'] = calculate_grade_letters(grades_df['marks'].to_numpy())
+        grade_records = []
         for _, row in grades_df.iterrows():
-            student_id = student_map.get(row['student_admission_number'])
-            
-            student = Student.query.get(student_id)
-            if not student:
+            if row['student_admission_number'] not in student_map:
                 print(f"Skipping grade - student {row['student_admission_number']} not found.")
                 continue
             
-            school_id = student.school_id
+            student_id, school_id = student_map[row['student_admission_number']]
             subject_id = subject_map.get((row['subject_name'], school_id))
             teacher_id = teacher_map.get(row['teacher_username'])
             
             if student_id and subject_id and teacher_id:
-                grade = Grade(
-                    marks=int(row['marks']),
-                    grade_letter=calculate_grade_letter(int(row['marks'])),
-                    term=row['term'],
-                    student_id=student_id,
-                    subject_id=subject_id,
-                    teacher_id=teacher_id
-                )
-                db.session.add(grade)
+                grade_records.append({
+                    "marks": row['marks'],
+                    "grade_letter": row['grade_letter'],
+                    "term": row['term'],
+                    "student_id": student_id,
+                    "subject_id": subject_id,
+                    "teacher_id": teacher_id
+                })
             else:
                 print(f"Skipping grade for {row['student_admission_number']} - missing relation.")
                 
+        if grade_records:
+            db.session.execute(insert(Grade), grade_records)
+            refresh_school_metrics()
         db.session.commit()
         print("Grades loaded.")
         print("--- Mock Data Load Complete ---")
 
     except Exception as e:
         db.session.rollback()
-        print(f"An error occurred during data loading: {e}")
\ No newline at end of file
+        print(f"An error occurred during data loading: {e}")
@@ -1,53 +1,154 @@
 # utils/pdf_generator.py
 # Uses WeasyPrint to convert a rendered HTML template into a PDF report.
 
-from flask import render_template
+from flask import render_template, current_app
 from weasyprint import HTML, CSS
+from weasyprint.text.fonts import FontConfiguration
+from pypdf import PdfWriter
+import hashlib
+import multiprocessing
+import numpy as np
 import io
+import os
+import threading
+import uuid
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime # <--- ADDED IMPORT
 
-def generate_pdf_report(student, grades, term):
+# Parsed once at import and shared by every report, instead of re-parsing an inline <style> per PDF.
+# The font configuration is shared too, so fontconfig lookups are reused across reports.
+FONT_CONFIG = FontConfiguration()
+REPORT_CSS = CSS(font_config=FONT_CONFIG, filename=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'static', 'report.css'))
+
+# Layout is CPU-bound Python, so a class's cards are split across worker processes to use
+# every core; threads would just take turns on the GIL. Created by the first bulk render.
+_render_pool = None
+_render_pool_pid = None
+_render_pool_lock = threading.Lock()
+# Workers come from a clean forkserver (or spawned) process, never forked from a threaded server
+_RENDER_START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+def _get_render_pool(workers):
     """
-    Generates a PDF report card for a student for a specific term.
-    
-    Args:
-        student (Student): The student object.
-        grades (list[Grade]): List of grade objects for the term.
-        term (str): The specific term (e.g., "Term 1 2025").
-        
-    Returns:
-        bytes: The generated PDF as a byte string.
+    This process's bulk render pool, created on first use; None when workers < 2.
+
+    A process forked after the pool was made (e.g. gunicorn --preload) can't
+    use its parent's pool, so it gets its own.
     """
-    
-    # Calculate summary statistics
-    total_marks = sum(g.marks for g in grades)
-    num_subjects = len(grades)
-    average_marks = total_marks / num_subjects if num_subjects > 0 else 0
+    global _render_pool, _render_pool_pid
+    if workers < 2:
+        return None
+    with _render_pool_lock:
+        if _render_pool is None or _render_pool_pid != os.getpid():
+            _render_pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(_RENDER_START_METHOD))
+            _render_pool_pid = os.getpid()
+        return _render_pool
+
+def _html_to_pdf(rendered_html):
+    """Runs in a worker process: lays out the HTML and returns the PDF bytes."""
+    return HTML(string=rendered_html).write_pdf(stylesheets=[REPORT_CSS], font_config=FONT_CONFIG)
+
+def _report_summary(grades):
+    """Calculates the summary statistics shown at the bottom of a report card."""
+    marks = np.fromiter((g.marks for g in grades), dtype=np.int64, count=len(grades))
+    total_marks = int(marks.sum())
+    average_marks = float(marks.mean()) if marks.size else 0
     
     # (A real system would calculate rank here by querying other students)
     class_rank = "N/A" 
     
-    summary = {
+    return {
         "total_marks": total_marks,
         "average_marks": f"{average_marks:.2f}",
         "class_rank": class_rank,
         "principal_remark": "A promising term. Keep up the good work.",
         "teacher_remark": "Consistent effort shown in all subjects."
     }
+
+def cached_pdf_report(student, grades, term):
+    """
+    Returns the path of the student's report card PDF for a term, rendering it only if needed.
+    
+    Files live in a REPORT_CACHE_DIR subdirectory per (student, term), named
+    by a fingerprint of everything the card shows: the student, school and
+    form, and every grade with its subject and teacher. Any change therefore
+    produces a new file instead of serving a stale one, and the superseded
+    file in that subdirectory is deleted, so each holds at most one card.
+    
+    Returns:
+        str: Path to the PDF file.
+    """
+    # The form and the footer's year both change with the calendar year
+    fingerprint = repr((student.id, student.full_name, student.admission_number, student.school.name,
+                        student.form, datetime.utcnow().year, term,
+                        sorted((g.id, g.subject.name, g.marks, g.teacher.full_name) for g in grades)))
+    cache_dir = os.path.join(current_app.config['REPORT_CACHE_DIR'], hashlib.sha1(repr((student.id, term)).encode()).hexdigest())
+    name = hashlib.sha1(fingerprint.encode()).hexdigest() + '.pdf'
+    path = os.path.join(cache_dir, name)
+    if not os.path.exists(path):
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write under a unique name first so concurrent readers never see a partial file
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'wb') as f:
+            generate_bulk_pdf_report([(student, grades)], term, target=f)
+        os.replace(tmp_path, path)
+        # Only this student and term's directory is scanned: the older card, if any
+        for entry in os.scandir(cache_dir):
+            if entry.name.endswith('.pdf') and entry.name != name:
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass  # Another worker evicted it first
+    return path
+
+def generate_bulk_pdf_report(student_grades, term, target=None):
+    """
+    Generates one PDF holding a report card per student, each starting on a new page.
+    
+    The students are split into one contiguous batch per render worker. Each
+    batch is a single HTML document, laid out in its own process, and the
+    resulting PDFs are joined in order. Without a pool (or for one student)
+    everything is one document rendered in this process.
+    
+    Args:
+        student_grades (list[tuple[Student, list[Grade]]]): Each student with their grades for the term.
+        term (str): The specific term (e.g., "Term 1 2025").
+        target (file-like, optional): Where to write the PDF instead of returning it.
+        
+    Returns:
+        bytes: The generated PDF as a byte string, or None when written to target.
+    """
+    workers = current_app.config['REPORT_RENDER_WORKERS']
+    pool = _get_render_pool(workers) if len(student_grades) > 1 else None
+    if pool is None:
+        # Use WeasyPrint to generate the PDF, in memory unless a target file is given
+        rendered_html = _render_report_html(student_grades, term)
+        return HTML(string=rendered_html).write_pdf(target, stylesheets=[REPORT_CSS], font_config=FONT_CONFIG)
+
+    batch_count = min(workers, len(student_grades))
+    batch_size = -(-len(student_grades) // batch_count)
+    # Templates render here (they need the app context); only HTML strings cross to the workers
+    batches = [_render_report_html(student_grades[i:i + batch_size], term) for i in range(0, len(student_grades), batch_size)]
+    writer = PdfWriter()
+    for pdf_bytes in pool.map(_html_to_pdf, batches):
+        writer.append(io.BytesIO(pdf_bytes))
+    output = target if target is not None else io.BytesIO()
+    writer.write(output)
+    return None if target is not None else output.getvalue()
+
+def _render_report_html(student_grades, term):
+    """Renders the report card template for each (student, grades) pair into one HTML document."""
+    reports = [
+        {"student": student, "grades": grades, "summary": _report_summary(grades)}
+        for student, grades in student_grades
+    ]
     
     # Render the HTML template with data
     # We pass 'base_url' to help WeasyPrint find static assets if any
-    rendered_html = render_template(
+    return render_template(
         'reports/pdf_template.html',
-        student=student,
-        grades=grades,
+        reports=reports,
         term=term,
-        summary=summary,
         now=datetime.utcnow(),  # <--- THIS IS THE FIX
         base_url='.' 
     )
-    
-    # Use WeasyPrint to generate the PDF in memory
-    pdf_bytes = HTML(string=rendered_html).write_pdf()
-    
-    return pdf_bytes
\ No newline at end of file
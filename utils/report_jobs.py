@@ -0,0 +1,62 @@
+# utils/report_jobs.py
+# Renders PDF report cards in a background worker so requests don't block on WeasyPrint.
+
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from models import db, Student, Grade
+from sqlalchemy.orm import joinedload
+from utils.pdf_generator import cached_pdf_report
+
+JOB_TTL_SECONDS = 600
+
+# Job records live in the app's shared cache, not in this process, so a status poll
+# can be answered by any worker; the render itself runs on the worker that queued it
+
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='report-pdf')
+
+def _job_key(job_id):
+    return f"report-job:{job_id}"
+
+def _render_report(app, student_id, term):
+    """Runs in a worker thread: loads the data and returns the path of the rendered PDF."""
+    with app.app_context():
+        try:
+            student = db.session.get(Student, student_id)
+            grades = Grade.query.options(joinedload(Grade.subject), joinedload(Grade.teacher)).filter_by(student_id=student_id, term=term).all()
+            return cached_pdf_report(student, grades, term)
+        finally:
+            db.session.remove()
+
+def _run_job(app, cache, job_id, job, student_id, term):
+    """Renders the report and records the outcome for whichever worker answers the next poll."""
+    try:
+        job.update(status="done", path=_render_report(app, student_id, term))
+    except Exception:
+        app.logger.exception("Report job %s failed", job_id)
+        job.update(status="failed")
+    with app.app_context():
+        cache.set(_job_key(job_id), job, timeout=JOB_TTL_SECONDS)
+
+def submit_report_job(app, cache, user_id, student_id, term, filename):
+    """
+    Queues a report card render and returns its job id.
+
+    The job remembers the requesting user so only they can collect the result.
+    """
+    job_id = uuid.uuid4().hex
+    job = {"status": "pending", "user_id": user_id, "filename": filename}
+    cache.set(_job_key(job_id), job, timeout=JOB_TTL_SECONDS)
+    _executor.submit(_run_job, app, cache, job_id, dict(job), student_id, term)
+    return job_id
+
+def get_report_job(cache, job_id):
+    """
+    Returns the job record for job_id, or None if unknown or expired.
+
+    The record's status is "pending", "done" (with the PDF's path) or "failed".
+    """
+    return cache.get(_job_key(job_id))
+
+def discard_report_job(cache, job_id):
+    cache.delete(_job_key(job_id))